@@ -210,6 +210,34 @@ def ideal_mean_field_jacobian(kf,kr,theta,p,mpf,matrix):
     return J
 """
 
+templates['interacting_mean_field_sparse_jacobian'] = """
+def interacting_mean_field_sparse_jacobian(rxn_parameters,theta,p,gas_energies,site_energies,T,F,mpf,matrix,mpexp):
+
+    ${kB}
+    ${n_adsorbates}
+    kBT = kB*T
+
+    ${rate_constants_with_derivatives}
+
+    kf, kr, dEf, dEr = rate_constants(
+                          rxn_parameters,theta,gas_energies,site_energies,T,F,
+                          mpf,matrix,mpexp,include_derivatives=True)
+    ${sparse_jacobian_expressions}
+    
+    J = matrix(J_data,J_rows,J_cols,n_adsorbates)
+    return J
+"""
+
+templates['ideal_mean_field_sparse_jacobian'] = """
+def ideal_mean_field_sparse_jacobian(kf,kr,theta,p,mpf,matrix):
+    ${n_adsorbates}
+
+    ${sparse_jacobian_expressions_no_derivatives}
+
+    J = matrix(J_data,J_rows,J_cols,n_adsorbates)
+    return J
+"""
+
 templates['first_order_interaction_function'] = """
 def interaction_function(coverages,energies,interaction_vector,F,include_derivatives=True): 
 
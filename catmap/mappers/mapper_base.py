@@ -3,10 +3,15 @@ import numpy as np
 import mpmath as mp
 import cPickle as pickle
 import os
+import fcntl
+import itertools
+import hashlib
+from pprint import pformat
 from copy import copy
 from catmap.model import ReactionModel
 from catmap import ReactionModelWrapper
 from catmap import plt
+from coverage_grid import CoverageGrid
 
 class MapperBase(ReactionModelWrapper):
     def __init__(self,reaction_model=ReactionModel()):
@@ -27,6 +32,15 @@ class MapperBase(ReactionModelWrapper):
         load_map(map_file):  loads a "map" list by loading a pickle from 
             the map_file
 
+        checkpoint_file: if set, points solved while mapping are appended 
+            to this file every checkpoint_interval points. If a map is 
+            interrupted, the next call to get_output_map loads the points 
+            in the file and only solves the remaining points. The file is 
+            removed once the map is finished. A file written for different 
+            reactions, outputs, descriptor ranges, resolution, conditions 
+            or species definitions (energies) is not used or changed, and 
+            the map is solved without checkpoints.
+
         A functional derived mapper class must also contain the methods:
 
         get_coverage_map(descriptor_ranges,resolution): a function which 
@@ -39,9 +53,21 @@ class MapperBase(ReactionModelWrapper):
 
         """
         self._rxm = reaction_model
+        defaults = dict(
+                checkpoint_file = None,
+                checkpoint_interval = 50,
+                )
+        self._rxm.update(defaults,override=False)
+        self._required = {'checkpoint_interval':int}
+        self._log_strings = {
+                'checkpoint_success':
+                "loaded ${n_points} points from ${checkpoint_file}",
+                'checkpoint_fail':
+    "${checkpoint_file} is from a different model or grid; not using it."
+                }
         self._solver_output = ['coverage','rate', #outputs requiring solver
                 'turnover_frequency','selectivity','rate_control',
-                'noninteracting_coverages']
+                'noninteracting_coverages','working_precision']
 
     def get_point_output(self,descriptors,*args,**kwargs):
         self.solver.compile()
@@ -69,10 +95,125 @@ class MapperBase(ReactionModelWrapper):
         self.solver.set_output_attrs(params)
         self.scaler.set_output_attrs(descriptors)
 
+        if not getattr(self,'_output_grids',None):
+            self._output_grids = {}
         for out in self.output_variables:
-            mapp = getattr(self,'_'+out+'_temp',{})
-            mapp[repr(descriptors)] = getattr(self,'_'+out)
-            setattr(self,'_'+out+'_temp',mapp)
+            if out not in self._output_grids:
+                self._output_grids[out] = CoverageGrid()
+            self._output_grids[out].add(
+                    descriptors,getattr(self,'_'+out),overwrite=True)
+
+        checkpoint = getattr(self,'_checkpoint_points',None)
+        if checkpoint is not None:
+            outputs = {}
+            for out in self._output_variables:
+                outputs[out] = getattr(self,'_'+out)
+            checkpoint.append([descriptors,outputs])
+            if len(checkpoint) >= self.checkpoint_interval:
+                self.save_checkpoint()
+
+    def get_checkpoint_header(self,descriptor_ranges,resolution):
+        """Identifies the model and grid which a checkpoint file belongs 
+        to. The temperature and pressure are only included if they are not 
+        descriptors (which the scaler changes at each point), and the 
+        energies and gas pressures through a hash of the species 
+        definitions."""
+        conditions = []
+        if 'temperature' not in self.descriptor_names:
+            conditions.append(['temperature',self.temperature])
+        if not [d for d in ['pressure','logPressure'] 
+                if d in self.descriptor_names]:
+            conditions.append(['pressure',getattr(self,'pressure',None)])
+        species = hashlib.sha1(
+                pformat(self.species_definitions)).hexdigest()
+        return repr([self.descriptor_names, self.elementary_rxns,
+            self.output_variables, 
+            [[float(d) for d in dr] for dr in descriptor_ranges],
+            np.array(resolution).tolist(), conditions, species])
+
+    def load_checkpoint(self,descriptor_ranges,resolution):
+        """Load the points in checkpoint_file as a list of 
+        [descriptors,{output:value}] and start saving solved points. 
+        Incomplete records from an interrupted write are discarded and the 
+        file is re-written. If the file has a different header (see 
+        get_checkpoint_header) it is left unchanged and no points are 
+        loaded or saved."""
+        points = []
+        self._checkpoint_points = None
+        if not self.checkpoint_file:
+            return points
+        header = self.get_checkpoint_header(descriptor_ranges,resolution)
+        if os.path.exists(self.checkpoint_file):
+            records = []
+            f = open(self.checkpoint_file,'rb')
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except Exception: #end of file or incomplete record
+                    break
+            f.close()
+            if records and records[0] == header:
+                for record in records[1:]:
+                    points += record
+                self.log('checkpoint_success',
+                        n_points = len(points),
+                        checkpoint_file = self.checkpoint_file,
+                        pt = 'mapper')
+            else:
+                self.log('checkpoint_fail',
+                        checkpoint_file = self.checkpoint_file,
+                        pt = 'mapper')
+                return points
+        f = open(self.checkpoint_file,'wb')
+        pickle.dump(header,f,-1)
+        if points:
+            pickle.dump(points,f,-1)
+        f.close()
+        self._checkpoint_points = []
+        return points
+
+    def save_checkpoint(self):
+        """Append the points solved since the last save to checkpoint_file.
+        The file is locked while writing, so that worker processes can 
+        share it."""
+        checkpoint = getattr(self,'_checkpoint_points',None)
+        if not checkpoint:
+            return
+        data = pickle.dumps(checkpoint,-1)
+        f = open(self.checkpoint_file,'ab')
+        fcntl.flock(f,fcntl.LOCK_EX)
+        try:
+            f.write(data)
+            f.flush()
+        finally:
+            fcntl.flock(f,fcntl.LOCK_UN)
+            f.close()
+        self._checkpoint_points = []
+
+    def apply_checkpoint(self,points):
+        """Add the outputs of the checkpoint points to the output grids.
+        Returns the points with coverages as a list of 
+        [descriptors,coverages]."""
+        coverages = []
+        for pt,outputs in points:
+            for out in outputs:
+                if out in self._output_grids:
+                    self._output_grids[out].add(pt,outputs[out])
+            if outputs.get('coverage',None) is not None:
+                coverages.append([pt,outputs['coverage']])
+        return coverages
+
+    def get_descriptor_axes(self,descriptor_ranges,resolution):
+        """Return a list of arrays with the values of each descriptor on 
+        the grid defined by descriptor_ranges and resolution. The resolution
+        can be a single number or a number for each descriptor."""
+        resolution = np.array(resolution)
+        if resolution.size == 1:
+            resolution = [float(resolution)]*len(descriptor_ranges)
+        elif resolution.size != len(descriptor_ranges):
+            raise ValueError('Resolution is not the correct shape')
+        return [np.linspace(dmin,dmax,int(res)) 
+                for (dmin,dmax),res in zip(descriptor_ranges,resolution)]
 
     def get_output_map(self,descriptor_ranges,resolution,*args,**kwargs):
         self.solver.compile()
@@ -86,6 +227,13 @@ class MapperBase(ReactionModelWrapper):
                 self._output_variables.remove('coverage')
                 self._output_variables = ['coverage'] + self._output_variables
         
+        axes = self.get_descriptor_axes(descriptor_ranges,resolution)
+        self._output_grids = {}
+        for out in self.output_variables:
+            self._output_grids[out] = CoverageGrid(axes)
+        self._checkpoint_map = self.load_checkpoint(
+                descriptor_ranges,resolution)
+
         # Need coverages for solver vars
         ismapped = False
         for out in self._output_variables:
@@ -96,35 +244,23 @@ class MapperBase(ReactionModelWrapper):
                 ismapped = True
 
         if ismapped == False:
-            #HACK - the following code is copy-pasted from min_resid_mapper.
-            #need to abstract it out.
-            resolution = np.array(resolution)
-            if resolution.size == 1:
-                resx = resy = float(resolution)
-            elif resolution.size == 2:
-                resx = resolution[0]
-                resy = resolution[1]
-            else:
-                raise ValueError('Resolution is not the correct shape')
-            
-            d1min,d1max = descriptor_ranges[0]
-            d2min,d2max = descriptor_ranges[1]
-            d1Vals = np.linspace(d1min,d1max,resx)
-            d2Vals = np.linspace(d2min,d2max,resy)
-            #ENDHACK
-            for d1V in d1Vals:
-                for d2V in d2Vals:
-                    self._descriptors = [d1V,d2V]
-                    self.get_point_output(self._descriptors)
+            self.apply_checkpoint(self._checkpoint_map)
+            for pt in itertools.product(*axes):
+                if False not in [pt in self._output_grids[out] 
+                        for out in self.output_variables]:
+                    continue #loaded from checkpoint
+                self._descriptors = list(pt)
+                self.get_point_output(self._descriptors)
+
+        if self._checkpoint_points is not None: #not a rejected file
+            self._checkpoint_points = None
+            self._checkpoint_map = []
+            if os.path.exists(self.checkpoint_file):
+                os.remove(self.checkpoint_file)
 
         for out in self.output_variables:
-#            if getattr(self,out+'_map'):
-#                mapp = getattr(self,out+'_map')
-#            else:
-            map_dict = getattr(self,'_'+out+'_temp',[])
-            mapp = []
-            for key in map_dict:
-                mapp.append([eval(key),map_dict[key]])
+            mapp = [[[float(d) for d in pt],val] 
+                    for pt,val in self._output_grids[out].to_list()]
             setattr(self,out+'_map',mapp)
 
             if getattr(self,out+'_map_file'):
@@ -1,4 +1,34 @@
 from mapper_base import *
+import multiprocessing
+import itertools
+import heapq
+
+#Mapper used by the worker processes of MinResidMapper.parallel_minresid_map.
+#The workers are forked from the parent process, so they inherit the mapper 
+#(and reaction model) rather than having to pickle it.
+_parallel_mapper = None
+
+def _minresid_map_tile(tile):
+    "Map one tile of the descriptor grid in a worker process."
+    mapper = _parallel_mapper
+    axes, isMapped = tile
+    mapper._log_lines = []
+    mapper._log_dict = {}
+    isMapped = mapper.minresid_map(axes,isMapped)
+    mapper.save_checkpoint()
+    output_grids = getattr(mapper,'_output_grids',None) or {}
+    output_maps = {}
+    for out in output_grids:
+        output_maps[out] = output_grids[out].to_list()
+    #Grid versions are not shared between processes, so residuals of 
+    #solved coverages are returned without their version.
+    residuals = []
+    for (pt,source,version),resid in mapper._residual_cache.items():
+        if not isinstance(version,tuple):
+            version = None
+        residuals.append([pt,source,version,resid])
+    return (isMapped, mapper._coverage_grid.to_list(), output_maps, 
+            mapper._log_lines, mapper._log_dict, residuals)
 
 class MinResidMapper(MapperBase):
     def __init__(self,reaction_model = ReactionModel()):
@@ -11,15 +41,25 @@ class MinResidMapper(MapperBase):
                 max_initial_guesses = 3,
                 descriptor_decimal_precision = 2,
                 extrapolate_coverages = False,
+                continuation_mode = 'bisection',
+                guess_ranking = 'exact',
+                n_workers = 1,
+                batch_initial_guesses = False,
                 )
         for v in self.output_variables:
             defaults['_'+v+'_map'] = None
 
         self._rxm.update(defaults,override=False)
+        self._residual_cache = {}
+        self._float_parameter_cache = {}
         self._required = {'search_directions':list,
                 'max_bisections':int,
                 'descriptor_decimal_precision':int,
-                'extrapolate_coverages':bool}
+                'extrapolate_coverages':bool,
+                'continuation_mode':str,
+                'guess_ranking':str,
+                'n_workers':int,
+                'batch_initial_guesses':bool}
         self._log_strings = {
                 'bisection_success':
                 "moved from ${old_pt} to ${new_pt}",
@@ -27,8 +67,14 @@ class MinResidMapper(MapperBase):
                 "move from ${old_pt} to ${new_pt}",
                 'bisection_maxiter':
                 "maximum iterations bisecting from ${old_pt} to ${new_pt}",
+                'continuation_success':
+                "moved from ${old_pt} to ${new_pt}",
+                'continuation_fail':
+                "move from ${old_pt} to ${new_pt} (residual = ${resid})",
                 'minresid_success':
                 "${pt} using coverages from ${old_pt}",
+                'fallback_success':
+    "${pt} by integrating from its best guess (residual = ${resid})",
                 'minresid_status':
                 "trying coverages from ${old_pt} at ${pt}",
                 'minresid_fail':
@@ -52,6 +98,49 @@ class MinResidMapper(MapperBase):
                 "no coverages at ${pt}"
                         }
 
+    def get_guess_residual(self,descriptors,source,coverages,guess=None):
+        """Residual at descriptors of the coverages found at the point 
+        source. Residuals are cached by the two points and the version of 
+        the coverages at source in the coverage grid, so they are only 
+        re-computed if the coverages at source change. Coverages which are
+        not stored at source (e.g. Boltzmann guesses) must be labelled by 
+        guess to be cached. The cache is emptied by clear_residual_cache."""
+        grid = self._coverage_grid
+        if guess is None:
+            version = grid.version(source)
+        else:
+            version = guess
+        key = (grid.key(descriptors),grid.key(source),version)
+        if version is None or key not in self._residual_cache:
+            self._descriptors = descriptors
+            self._coverage = coverages
+            resid = self.solver.get_residual(coverages)
+            if version is None:
+                return resid
+            self._residual_cache[key] = resid
+        return self._residual_cache[key]
+
+    def get_guess_scores(self,descriptors,coverage_list):
+        """Approximate (float64) residuals at descriptors of each of the 
+        coverages in coverage_list, used to rank guesses before their full 
+        precision residuals are computed. The float64 parameters of each 
+        point are cached along with the residuals."""
+        key = self._coverage_grid.key(descriptors)
+        if key not in self._float_parameter_cache:
+            self._descriptors = descriptors
+            params = self.scaler.get_rxn_parameters(descriptors)
+            self._rxn_parameters = params
+            self._float_parameter_cache[key] = \
+                    self.solver.get_float_parameters(params)
+        return self.solver.get_approximate_residuals(coverage_list,
+                self._float_parameter_cache[key])
+
+    def clear_residual_cache(self):
+        """Empty the cache of residuals. Must be called if the model is 
+        changed in a way that changes the residuals at a point."""
+        self._residual_cache = {}
+        self._float_parameter_cache = {}
+
     def get_initial_coverage(self,descriptors,*args,**kwargs):
         "Shortcut to solver.get_initial_coverage"
         params = self.scaler.get_rxn_parameters(descriptors)
@@ -60,7 +149,7 @@ class MinResidMapper(MapperBase):
     def get_point_coverage(self,descriptors,*args,**kwargs):
         "Shortcut to get coverages at a point."
         #Check to see if point has already been solved
-        current= self.retrieve_data(self._coverage_map,
+        current= self.retrieve_data(getattr(self,'_coverage_grid',None),
                 descriptors,
                 self.descriptor_decimal_precision)
         if current:
@@ -150,7 +239,7 @@ class MinResidMapper(MapperBase):
                     current_descriptors,solved_descriptors,current_cvgs)
             descriptors1 = solved_descriptors
             coverages1 = current_cvgs
-            self._coverage_map.append([solved_descriptors,current_cvgs])
+            self._coverage_grid.add(solved_descriptors,current_cvgs)
             if solved_descriptors == new_descriptors:
                 PCconverged = True
                 return current_cvgs
@@ -171,6 +260,73 @@ class MinResidMapper(MapperBase):
                     self.print_point(old_descriptors) + ' to ' + \
                     self.print_point(new_descriptors))
 
+    def continue_descriptor_line(self, new_descriptors, old_descriptors,
+            initial_guess_coverages):
+        """Find coverages at point new_descriptors given that coverages are 
+        initial_guess_coverages at old_descriptors by predictor-corrector 
+        continuation along the line between the points. The coverages at 
+        each step are predicted from the tangent dtheta/dx = -J^-1 df/dx 
+        and corrected by the solver. The step is halved upon failure to 
+        converge and doubled after each successful step, down to a minimum
+        of 2**-max_bisections of the distance between the points."""
+        direction = [float(d1)-float(d0) 
+                for d1,d0 in zip(new_descriptors,old_descriptors)]
+        min_step = 0.5**self.max_bisections
+        t = 0.0
+        step = 0.5 #the full step has already been tried
+        current_descriptors = old_descriptors
+        current_cvgs = initial_guess_coverages
+        tangent = None
+        n_iter = 0
+        while True:
+            n_iter += 1
+            if tangent is None:
+                try:
+                    tangent = self.solver.get_coverage_derivative(
+                            current_cvgs,current_descriptors,direction)
+                    tangent = [ti for ti in tangent]
+                except (ZeroDivisionError, np.linalg.LinAlgError):
+                    tangent = [0]*len(current_cvgs)
+
+            t_new = min(t + step, 1.0)
+            if t_new >= 1.0:
+                next_descriptors = new_descriptors
+            else:
+                next_descriptors = [float(d0)+t_new*d 
+                        for d0,d in zip(old_descriptors,direction)]
+            guess = [c + (t_new-t)*dc for c,dc in zip(current_cvgs,tangent)]
+            guess = self.solver.constrain_coverages(guess)
+            try:
+                self.get_point_output(next_descriptors, guess)
+                self.log('continuation_success',
+                        old_pt = self.print_point(current_descriptors),
+                        new_pt = self.print_point(next_descriptors),
+                        n_iter = n_iter)
+                current_cvgs = self._coverage
+                current_descriptors = next_descriptors
+                self._coverage_grid.add(current_descriptors,current_cvgs)
+                if t_new >= 1.0:
+                    return current_cvgs
+                t = t_new
+                step = 2*step
+                tangent = None
+
+            except ValueError:
+                resid = float(self.solver.get_residual(guess))
+                self.log('continuation_fail',
+                        old_pt = self.print_point(current_descriptors),
+                        new_pt = self.print_point(next_descriptors),
+                        n_iter = n_iter,
+                        resid = resid)
+                step = step/2.
+                if step < min_step:
+                    raise ValueError('Could not find a valid solution at ' + \
+                            self.print_point(next_descriptors) + \
+                            ' (Continued from ' + \
+                            self.print_point(current_descriptors) + \
+                            ' with a step of ' + str(2*step) + '.' + \
+                            ' (resid=' + str(resid) +'))')
+
     def get_coverage_map(self,descriptor_ranges=None,resolution = None,
             initial_guess_adsorbate_names=None):
         """Creates coverage map by computing residuals from nearby points 
@@ -180,40 +336,27 @@ class MinResidMapper(MapperBase):
         if resolution is None:
             resolution = self.resolution
 
-        resolution = np.array(resolution)
-        if resolution.size == 1:
-            resx = resy = float(resolution)
-        elif resolution.size == 2:
-            resx = resolution[0]
-            resy = resolution[1]
-        else:
-            raise ValueError('Resolution is not the correct shape')
-
-        d1min,d1max = descriptor_ranges[0]
-        d2min,d2max = descriptor_ranges[1]
-        d1Vals = np.linspace(d1min,d1max,resx)
-        d2Vals = np.linspace(d2min,d2max,resy)
-        def rev_nparray(nparray):
-            nparray = list(nparray)
-            nparray.reverse()
-            return np.array(nparray)
-        d1Vals = rev_nparray(d1Vals)
-        d2Vals = rev_nparray(d2Vals)
+        axes = [ax[::-1] for ax in 
+                self.get_descriptor_axes(descriptor_ranges,resolution)]
+        self._coverage_grid = CoverageGrid(axes,
+                self.descriptor_decimal_precision)
+        self.clear_residual_cache()
  
-        isMapped = np.zeros((resx,resy)) #matrix to track which 
-        #values have been checked/which directions have been searched
-        maxNum = int('1'*len(self.search_directions),2) #if number is higher 
-        #than this then the point should not be checked 
-        #(use binary representation to determine which directions have 
-        #been checked). Number can't be higher than having a 
-        #1 in every direction.
+        isMapped = np.zeros(self._coverage_grid.shape,dtype=bool) #array to 
+        #track which points have been solved
+
+        #Points solved before the map was interrupted
+        for point,point_coverages in self.apply_checkpoint(
+                getattr(self,'_checkpoint_map',None) or []):
+            self._coverage_grid.add(point,point_coverages)
+            idx = self._coverage_grid.index(point)
+            if idx is not None:
+                isMapped[idx] = True
 
         if self.coverage_map is None:
             initial_guess_coverage_map = None
-            self._coverage_map = []
         else:
             initial_guess_coverage_map = [c for c in self.coverage_map]
-            self._coverage_map = []
 
         #Clause for obtaining initial coverages from an initial guess map
         if initial_guess_coverage_map:
@@ -255,23 +398,15 @@ class MinResidMapper(MapperBase):
                 #If the point is of interest (in the d1/d2 vals) then use the 
                 #coverages from the initial guess map to try to find 
                 #the coverages.
-                n = self.descriptor_decimal_precision
-                if (np.round(point[0],n) in [np.round(d1V,n) 
-                        for d1V in d1Vals] 
-                        and np.round(point[1],n) in [np.round(d2V,n) 
-                            for d2V in d2Vals]):
-                    i = [np.round(d1V,n) 
-                            for d1V in d1Vals].index(np.round(point[0],n))
-                    j = [np.round(d2V,n) 
-                            for d2V in d2Vals].index(np.round(point[1],n))
+                idx = self._coverage_grid.index(point)
+                if idx is not None:
                     try:
                         self._coverage = guess_coverage
                         self.get_point_output(
                                 point,guess_coverage)
                         point_coverages = self._coverage
-                        self._coverage_map.append([point,point_coverages])
-                        isMapped[i,j] = int('1'+str(np.binary_repr(maxNum)),2) 
-                        #Set this value above the max number
+                        self._coverage_grid.add(point,point_coverages)
+                        isMapped[idx] = True
                         self.log('initial_success')
                     except ValueError:
                         self.log('initial_fail')
@@ -279,220 +414,294 @@ class MinResidMapper(MapperBase):
                     self._descriptors = point
                     self.log('initial_invalid')
         
-        #Helper function to iterate through "possibilities" and try them in 
-        #order of minimum residual. Returns a list of "new possibilities" 
-        #based on the best residual from each point.
-        def check_by_minresid(possibilities,this_pt,bisect=False):
-            new_possibilities = []
-            tried = []
-            for i_poss,poss in enumerate(possibilities): #sort by residual to 
-                r,sol_pt,c = poss
-                                                    #use best guesses first
-                self.log('minresid_status',
-                        priority=1,
-                        n_iter=i_poss,
+        if self.n_workers > 1:
+            isMapped = self.parallel_minresid_map(axes,isMapped)
+        isMapped = self.minresid_map(axes,isMapped)
+
+        self._coverage_map = self._coverage_grid.to_list()
+        return self._coverage_map
+
+    def get_search_directions(self,n_dims):
+        """Directions to the neighbours of a grid point in n_dims
+        dimensions. search_directions is used if it has the correct 
+        dimension, otherwise the stencil of all neighbouring points 
+        (including diagonals) is used, ordered from nearest to furthest."""
+        directions = [tuple(d) for d in self.search_directions 
+                if len(d) == n_dims and any(d)]
+        if directions:
+            return directions
+        stencil = np.array(list(itertools.product([-1,0,1],repeat=n_dims)))
+        stencil = stencil[np.abs(stencil).sum(axis=1) > 0]
+        stencil = stencil[np.argsort(np.abs(stencil).sum(axis=1),
+            kind='mergesort')]
+        return [tuple(d) for d in stencil]
+
+    def parallel_minresid_map(self,axes,isMapped):
+        """Split the grid into n_workers tiles along the first descriptor 
+        and map each tile with minresid_map in a worker process, so that 
+        points are seeded from their solved neighbours as in the serial 
+        mapper. Points left unsolved are retried by the serial pass using 
+        solutions from the neighbouring tiles.
+        Worker processes are forked, so this is only available on 
+        platforms which support fork."""
+        global _parallel_mapper
+        n_tiles = min(self.n_workers,len(axes[0]))
+        bounds = np.linspace(0,len(axes[0]),n_tiles+1).astype(int)
+        bounds = zip(bounds[:-1],bounds[1:])
+        tiles = [[[axes[0][a:b]]+list(axes[1:]),isMapped[a:b].copy()] 
+                for a,b in bounds]
+
+        self.save_checkpoint()
+        _parallel_mapper = self
+        pool = multiprocessing.Pool(self.n_workers)
+        try:
+            results = pool.map(_minresid_map_tile,tiles)
+        finally:
+            pool.close()
+            pool.join()
+            _parallel_mapper = None
+
+        if not getattr(self,'_output_grids',None):
+            self._output_grids = {}
+        tile_residuals = []
+        for (a,b),result in zip(bounds,results):
+            (tile_mapped, tile_map, output_maps, log_lines, log_dict, 
+                    residuals) = result
+            isMapped[a:b] = tile_mapped
+            for pt,cvgs in tile_map:
+                self._coverage_grid.add(pt,cvgs)
+            for out in output_maps:
+                if out not in self._output_grids:
+                    self._output_grids[out] = CoverageGrid()
+                for pt,val in output_maps[out]:
+                    self._output_grids[out].add(pt,val)
+            self._log_lines += log_lines
+            for pt in log_dict:
+                self._log_dict[pt] = self._log_dict.get(pt,[]) + log_dict[pt]
+            tile_residuals.append(residuals)
+
+        #The coverages of the tiles are now in the grid, so the residuals 
+        #computed by the workers can be reused by the serial pass.
+        for residuals in tile_residuals:
+            for pt,source,version,resid in residuals:
+                if version is None:
+                    version = self._coverage_grid.version(source)
+                self._residual_cache[(pt,source,version)] = resid
+
+        return isMapped
+
+    def minresid_map(self,axes,isMapped):
+        """Solve the unsolved points on the grid defined by the list of 
+        descriptor values along each axis. Candidate guess coverages 
+        (Boltzmann guesses and the coverages of solved neighbours) are kept 
+        in a priority queue ordered by their residual at the point they are 
+        a guess for. When a point is solved its coverages are pushed as 
+        candidates for its unsolved neighbours, so points are only 
+        revisited when new information becomes available. Bisections from 
+        failed neighbour guesses are only attempted once no direct attempts 
+        remain. With ode_fallback, points which are still unsolved when the 
+        queue is empty are solved one at a time by integrating in time 
+        from their lowest-residual guess (see 
+        SteadyStateSolver.get_integrated_coverage), and the queue is 
+        resumed from the new solution. isMapped is a boolean array of the 
+        solved points, and is returned once the queue is empty. Where there 
+        is more than one steady state, the order of the queue decides which 
+        guess a point converges from first, so the branch found can differ 
+        from the one found by sweeping the grid in order."""
+        shape = np.array(isMapped.shape)
+        directions = self.get_search_directions(len(shape))
+        queue = []
+        counter = itertools.count()
+        tried = {}
+        best_guess = {} #lowest residual guess attempted at each point
+        integrated = set()
+
+        def grid_point(idx):
+            return [ax[i] for ax,i in zip(axes,idx)]
+
+        def in_grid(idx):
+            return bool(np.all(np.array(idx) >= 0) and 
+                    np.all(np.array(idx) < shape))
+
+        #Helper function to add a guess for the target point to the queue. 
+        #Bisections (tier 1) are only popped once all direct attempts 
+        #(tier 0) have been exhausted. Guesses pushed with an approximate 
+        #residual are re-pushed with the full precision residual when they 
+        #reach the front of the queue.
+        def push(tier,target,source,coverages,resid=None,guess=None,
+                exact=True):
+            if resid is None:
+                resid = self.get_guess_residual(grid_point(target),
+                        grid_point(source),coverages,guess)
+            heapq.heappush(queue,(tier,resid,counter.next(),
+                target,source,coverages,guess,exact))
+
+        #Helper function to add a list of [source,coverages,guess] as 
+        #guesses for the target point, ranked by float64 residuals
+        def push_candidates(target,candidates):
+            if self.guess_ranking == 'float':
+                scores = self.get_guess_scores(grid_point(target),
+                        [c for source,c,guess in candidates])
+                for (source,c,guess),score in zip(candidates,scores):
+                    push(0,target,source,c,float(score),guess,False)
+            else:
+                for source,c,guess in candidates:
+                    push(0,target,source,c,guess=guess)
+
+        #Helper function to add the coverages of a newly solved point as 
+        #guesses for its unsolved neighbours
+        def push_neighbours(source):
+            cvgs = self._coverage_grid.get(grid_point(source))
+            for direc in directions:
+                target = tuple([i-d for i,d in zip(source,direc)])
+                if (in_grid(target) and not isMapped[target] 
+                        and (source,0) not in tried.get(target,[])):
+                    push_candidates(target,[[source,cvgs,None]])
+
+        n_unmapped = int(np.sum(~isMapped))
+        self.log('mapper_status',
+                n_unmapped=n_unmapped,
+                n_iter = 0,
+                pt = 'mapper')
+
+        #Boltzmann guesses at the unsolved points
+        initial_guesses = {}
+        for idx in np.ndindex(*isMapped.shape):
+            if isMapped[idx]:
+                continue
+            boltz_cvgs = self.get_initial_coverage(grid_point(idx))
+            if self.max_initial_guesses is not None:
+                boltz_cvgs = boltz_cvgs[:self.max_initial_guesses]
+            initial_guesses[idx] = [[('initial',n_guess),cvg] 
+                    for n_guess,cvg in enumerate(boltz_cvgs)]
+
+        #Solve all Boltzmann guesses in one batch, and use the solutions
+        #as guesses instead
+        if self.batch_initial_guesses and initial_guesses:
+            guess_list = [(idx,n) for idx in initial_guesses 
+                    for n in range(len(initial_guesses[idx]))]
+            solutions = self.solver.get_batch_coverages(
+                    [self.scaler.get_rxn_parameters(grid_point(idx)) 
+                        for idx,n in guess_list],
+                    [initial_guesses[idx][n][1] for idx,n in guess_list])
+            for (idx,n),cvg in zip(guess_list,solutions):
+                if cvg is not None:
+                    initial_guesses[idx][n] = [('batch',n),cvg]
+
+        #Seed the queue with Boltzmann guesses and the solved neighbours
+        for idx in np.ndindex(*isMapped.shape):
+            if isMapped[idx]:
+                continue
+            candidates = [[idx,cvg,guess] 
+                    for guess,cvg in initial_guesses[idx]]
+            for direc in directions:
+                source = tuple([i+d for i,d in zip(idx,direc)])
+                if in_grid(source):
+                    sol_cvgs = self._coverage_grid.get(grid_point(source))
+                    if sol_cvgs:
+                        candidates.append([source,sol_cvgs,None])
+            push_candidates(idx,candidates)
+
+        #Helper function to integrate the unsolved point with the lowest 
+        #residual guess which has not been integrated yet. Returns True if 
+        #a point was solved.
+        def integrate_unmapped():
+            if self.ode_fallback != True:
+                return False
+            pending = [idx for idx in best_guess 
+                    if not isMapped[idx] and idx not in integrated]
+            pending.sort(key=lambda idx: best_guess[idx][0])
+            for idx in pending:
+                integrated.add(idx)
+                pt = grid_point(idx)
+                self._descriptors = pt
+                resid, c = best_guess[idx]
+                try:
+                    params = self.scaler.get_rxn_parameters(pt)
+                    c = self.solver.get_integrated_coverage(params,c)
+                    self.get_point_output(pt,c)
+                except ValueError:
+                    continue
+                self._coverage_grid.add(pt,self._coverage)
+                isMapped[idx] = True
+                self.log('fallback_success',
+                        resid = float(resid))
+                push_neighbours(idx)
+                return True
+            return False
+
+        n_iter = 0
+        while queue or integrate_unmapped():
+            if not queue:
+                continue
+            tier,r,junk,target,source,c,guess,exact = heapq.heappop(queue)
+            if isMapped[target]:
+                continue
+            #allow multiple initial guesses
+            if source != target and (source,tier) in tried.get(target,[]):
+                continue
+            if not exact:
+                push(tier,target,source,c,guess=guess)
+                continue
+            if source != target:
+                tried.setdefault(target,[]).append((source,tier))
+            if target not in best_guess or r < best_guess[target][0]:
+                best_guess[target] = (r,c)
+            n_iter += 1
+            this_pt = grid_point(target)
+            sol_pt = grid_point(source)
+            self._descriptors = this_pt
+            self.log('minresid_status',
+                    priority=1,
+                    n_iter=n_iter,
+                    old_pt=self.print_point(
+                        sol_pt,self.descriptor_decimal_precision))
+            try:
+                if tier == 0 or source == target:
+                    self.get_point_output(this_pt,c)
+                    point_coverages = self._coverage
+                elif self.continuation_mode == 'tangent':
+                    point_coverages = self.continue_descriptor_line(
+                            this_pt,sol_pt,c)
+                else:
+                    point_coverages = self.bisect_descriptor_line(
+                            this_pt,sol_pt,c)
+                self._coverage_grid.add(this_pt,point_coverages)
+                isMapped[target] = True
+                self.log('minresid_success',n_iter=n_iter,
                         old_pt=self.print_point(
                             sol_pt,self.descriptor_decimal_precision))
+                push_neighbours(target)
 
+            except ValueError,strerror:
+                strerror = str(strerror)
+                resid = strerror.split('resid=')[-1]
+                resid = resid.split(')')[0]
+                try:
+                    resid_str = float(resid)
+                except ValueError:
+                    resid_str = resid
 
-                if sol_pt not in tried:
-                    try:
-                        if bisect == False or this_pt == sol_pt: #don't 
-                                                #bisect if the point is itself
-                            self.get_point_output(
-                                    this_pt,c)
-                            point_coverages = self._coverage
-                            if point_coverages:
-                                self._coverage_map.append(
-                                        [this_pt,point_coverages])
-                                self.log('minresid_success',n_iter=i_poss,
-                                      old_pt=self.print_point(
-                                      sol_pt,self.descriptor_decimal_precision))
-                        else:
-                            point_coverages = self.bisect_descriptor_line(
-                                    this_pt,sol_pt,c)
-                            if point_coverages:
-                                self._coverage_map.append(
-                                        [this_pt,point_coverages])
-                            self.log('minresid_success',n_iter=i_poss,
-                                    old_pt=sol_pt)
-                        return None
-
-                    except ValueError,strerror:
-                        strerror = str(strerror)
-                        resid = strerror.split('resid=')[-1]
-                        resid = resid.split(')')[0]
-                        try:
-                            resid_str = float(resid)
-                        except ValueError:
-                            resid_str = resid
-
-                        self.log('minresid_fail',n_iter=i_poss,
-                                old_pt=self.print_point(
-                                    sol_pt,self.descriptor_decimal_precision),
-                                resid=resid_str,
-                                old_resid=float(r))
-                        try:
-                            resid = float(resid)
-                            if this_pt != sol_pt:
-                                new_possibilities.append([resid,sol_pt,c]) #make
-                                #a new list of possibilities (used for 
-                                #bisections thus the boltzmann guess is 
-                                #omitted so that it is not tried twice)
-                        except ValueError:
-                            pass
-
-                if sol_pt != this_pt: #allow multiple initial guesses
-                    tried.append(sol_pt)
-
-            return new_possibilities
-    
-    #Function to iterate through all points and use current 
-    #information to make the best guess
-        def minresid_iteration(isMapped):
-            """Go through all points and check the local solutions in 
-            order of minimum to maximum residual"""
-            m,n = isMapped.shape
-            for i in range(0,m):
-                for j in range(0,n):
-                    possibilities = []
-                    this_pt = [d1Vals[i],d2Vals[j]]
-                    self._descriptors = this_pt
-                    if isMapped[i,j] < maxNum: #the point has not been foind yet
-                        #Get the list of possible guess coverages based 
-                        #on the search directions
-                        checked_dirs = [int(bi) 
-                                for bi in np.binary_repr(isMapped[i,j])] 
-                        #Use binary representation to keep track of which 
-                        #directions have been checked
-                        if len(checked_dirs) < len(self.search_directions): 
-                            #Add leading zeros if list is too small
-                            checked_dirs = [0]*(len(self.search_directions) -
-                                    len(checked_dirs))+checked_dirs
-                        for k,direc in enumerate(self.search_directions):
-                            dirx,diry = direc
-                            solx = i + dirx
-                            soly = j + diry
-                            if (
-                                    solx < m and 
-                                    solx >=0 and 
-                                    soly < n and 
-                                    soly>=0 and 
-                                    checked_dirs[k] == 0
-                                    ): # point is in map and hasn't been checked
-                                sol_pt = [d1Vals[solx],d2Vals[soly]]
-                                if sol_pt != this_pt:
-                                    sol_cvgs = self.retrieve_data(
-                                            self._coverage_map, 
-                                            sol_pt, 
-                                            self.descriptor_decimal_precision)
-                                else:
-                                    boltz_cvgs = self.get_initial_coverage(
-                                            this_pt)
-                                    if self.max_initial_guesses is not None:
-                                        max_initial_guesses = min(len(boltz_cvgs),self.max_initial_guesses)
-                                        boltz_cvgs = boltz_cvgs[:max_initial_guesses]
-                                    sol_cvgs = None
-                                    for cvg in boltz_cvgs:
-                                        self._coverage = cvg
-                                        params = self.scaler.get_rxn_parameters(
-                                                sol_pt)
-                                        resid = self.solver.get_residual(cvg)
-                                        possibilities.append(
-                                                [resid,sol_pt,cvg])
-                                    checked_dirs[k] = 1
-
-                                if sol_cvgs:
-                                    self._coverage = sol_cvgs
-                                    params = self.scaler.get_rxn_parameters(
-                                            sol_pt)
-                                    resid = self.solver.get_residual(sol_cvgs)
-                                    possibilities.append(
-                                            [resid,sol_pt,sol_cvgs])
-                                    checked_dirs[k] = 1
-                            else: #point is not in map. make it "checked"
-                                checked_dirs[k] = 1
-                           #Now we have the "possibilities" for guess coverages 
-                           #and their residuals
-                        possibilities = check_by_minresid(
-                                possibilities,this_pt,bisect=False) 
-                        #Try without bisection since it is much faster
-                        if possibilities and self.max_bisections>0: 
-                            #This implies the non-bisecting attempts failed.
-                           if self.verbose > 0:
-                               print('Unable to find solution at ' + \
-                                       self.print_point(this_pt) + \
-                                       ' from current information.'+ \
-                                       ' Attempting bisection.')
-                           possibilities = check_by_minresid(
-                                   possibilities,
-                                   this_pt,
-                                   bisect=True) 
-                        elif (
-                                possibilities is not None and 
-                                self.max_bisections>0
-                                ):
-                           if self.verbose > 0:
-                               print('Unable to find solution at '+ \
-                                       self.print_point(this_pt)+ \
-                                       ' from current information. '+\
-                                       'No nearby points for bisection.')
-
-                        if possibilities is None:
-                            isMapped[i,j] = int(
-                                    '1'+str(np.binary_repr(maxNum)),2) 
-                            #Set this value above the max number
-
-                        if isMapped[i,j] < maxNum: 
-                            #could not find solution. Add number to indicate 
-                            #how many directions have been checked. If new 
-                            #information becomes available later in this 
-                            #minresid iteration it will be utilized in the 
-                            #next minresid iteration
-                            binstring = ''.join(
-                                    [str(bi) for bi in checked_dirs])
-                            isMapped[i,j] = int(binstring,2)
-
-            return isMapped
-
-    #Perform minresid iterations
-        if not self._coverage_map:
-            self._coverage_map = []
-        norm_new = np.linalg.norm(isMapped)
-        norm_old = -1
-        minresiditer = 0
-        while norm_new > norm_old: #Iterate thorough until  no new information.
-            m,n = isMapped.shape
-            n_unmapped = 0 #Count how many points remain unmapped
-            for i in range(0,m):
-                for j in range(0,n):
-                    if isMapped[i,j] <= maxNum:
-                        n_unmapped+=1
-            self.log('mapper_status',
-                    n_unmapped=n_unmapped,
-                    n_iter = minresiditer,
-                    pt = 'mapper')
-            minresiditer +=1
-            norm_old = np.linalg.norm(isMapped)
-            isMapped = minresid_iteration(isMapped)
-            norm_new = np.linalg.norm(isMapped)
+                self.log('minresid_fail',n_iter=n_iter,
+                        old_pt=self.print_point(
+                            sol_pt,self.descriptor_decimal_precision),
+                        resid=resid_str,
+                        old_resid=float(r))
+                if (tier == 0 and source != target and 
+                        self.max_bisections > 0 and 
+                        not isinstance(resid_str,str)):
+                    #Boltzmann guesses are not bisected
+                    push(1,target,source,c,resid_str)
 
+        n_unmapped = int(np.sum(~isMapped))
         if n_unmapped == 0:
             self.log('mapper_success',
-                    n_iter = minresiditer,
+                    n_iter = n_iter,
                     pt = 'mapper', priority=1)
         else:
             self.log('mapper_fail',
                     n_unmapped=n_unmapped,
-                    n_iter = minresiditer,
+                    n_iter = n_iter,
                     pt = 'mapper')
 
-        nodups = []
-        pts = []
-        for pt,cvgs in self._coverage_map:
-            if pt not in pts:
-                pts.append(pt)
-                nodups.append([pt,cvgs])
-        self._coverage_map = nodups #remove duplicate points
-        return self._coverage_map
-
+        return isMapped
@@ -7,12 +7,34 @@ import catmap
 from string import Template
 import functions
 import re
+import multiprocessing
 from data import regular_expressions
 string2symbols = catmap.string2symbols
 pickle = catmap.pickle
 plt = catmap.plt
 griddata = catmap.griddata
 
+#Model used by the worker processes of ReactionModel.multi_point_analysis.
+#The workers are forked from the parent process, so they inherit the model 
+#rather than having to pickle it.
+_parallel_model = None
+
+def _point_output(pt):
+    "Find the outputs at a single point in a worker process."
+    model = _parallel_model
+    model._log_lines = []
+    model._log_dict = {}
+    try:
+        model.mapper.get_point_output(pt)
+        outputs = {}
+        for out in model.output_variables:
+            outputs[out] = getattr(model,'_'+out)
+        error = None
+    except Exception, error:
+        outputs = None
+        error = str(error)
+    return outputs, error, model._log_lines, model._log_dict
+
 class ReactionModel:
     def __init__(self,**kwargs): #
         """Class for managing microkinetic models.
@@ -53,7 +75,9 @@ class ReactionModel:
         self._log_strings = {'input_success':
                              'loaded all data from input file',
                              'header_fail':
-                             'could not save ${save_txt}'}
+                             'could not save ${save_txt}',
+                             'point_fail':
+                             'no solution at ${pt}: ${error}'}
         #modules to import in the log file to allow opening with python -i
         self._log_imports = "from numpy import array\n\n"+\
                             "import cPickle as pickle\n\n"
@@ -82,8 +106,10 @@ class ReactionModel:
         #rxn_direction
         #selectivity
         #rate_control
+        #apparent_activation_energy
         #rate_constant
         #equilibrium_constant
+        #working_precision
 
         ##Scaler level
         #rxn_parameter
@@ -267,8 +293,44 @@ class ReactionModel:
             setattr(self,out+'_map',mapp)
 
     def multi_point_analysis(self):
-        for pt in self.descriptor_values:
-            self.single_point_analysis(pt)
+        n_workers = getattr(self,'n_workers',None) or 1
+        if n_workers > 1 and len(self.descriptor_values) > 1:
+            self.parallel_multi_point_analysis(n_workers)
+        else:
+            for pt in self.descriptor_values:
+                self.single_point_analysis(pt)
+
+    def parallel_multi_point_analysis(self,n_workers):
+        """Find rates/coverages at the points in descriptor_values using 
+        n_workers forked worker processes. Outputs are appended to the maps 
+        in the order of descriptor_values, as in single_point_analysis. 
+        Points which fail are logged and left out of the maps rather than 
+        stopping the analysis."""
+        global _parallel_model
+        self.solver.compile() #compile once rather than in every worker
+        _parallel_model = self
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            results = pool.map(_point_output,self.descriptor_values)
+        finally:
+            pool.close()
+            pool.join()
+            _parallel_model = None
+
+        for pt,result in zip(self.descriptor_values,results):
+            outputs, error, log_lines, log_dict = result
+            self._log_lines += log_lines
+            for key in log_dict:
+                self._log_dict[key] = self._log_dict.get(key,[]) + \
+                        log_dict[key]
+            if outputs is None:
+                self._descriptors = pt
+                self.log('point_fail',error=error)
+                continue
+            for out in self.output_variables:
+                mapp = getattr(self,out+'_map',[])
+                mapp.append([pt,outputs[out]])
+                setattr(self,out+'_map',mapp)
 
     def generate_static_functions(self):
         "Dynamically compile static functions"
@@ -767,22 +829,24 @@ class ReactionModel:
     def retrieve_data(self,mapp,point,precision=2):
         if not mapp:
             return None
+        if hasattr(mapp,'get'): #grid store (catmap.mappers.CoverageGrid)
+            return mapp.get(point)
         n = precision
         if not hasattr(self,'_dict_maps'):
             self._dict_maps = {}
         if id(mapp) not in self._dict_maps:
-            self._dict_maps[id(mapp)] = {}
-            for pt,cvg in mapp:
-                pt = tuple([round(v,n) for v in pt])
-                self._dict_maps[id(mapp)][pt] = cvg
+            self._dict_maps[id(mapp)] = [0,{}]
+        n_read, dict_map = self._dict_maps[id(mapp)]
+        if n_read > len(mapp): #list was replaced or truncated
+            n_read = 0
+            dict_map.clear()
+        #only read points appended since the last call
+        for pt,cvg in mapp[n_read:]:
+            pt = tuple([round(v,n) for v in pt])
+            dict_map[pt] = cvg
+        self._dict_maps[id(mapp)][0] = len(mapp)
         newpt = tuple([round(v,n) for v in point])
-        try:
-            return self._dict_maps[id(mapp)][newpt]
-        except KeyError:
-            for pt,cvg in mapp:
-                pt = tuple([round(v,n) for v in pt])
-                self._dict_maps[id(mapp)][pt] = cvg
-        return self._dict_maps[id(mapp)].get(newpt,None)
+        return dict_map.get(newpt,None)
 
     @staticmethod
     def map_to_array(mapp,descriptor_ranges,resolution,
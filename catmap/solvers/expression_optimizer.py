@@ -0,0 +1,534 @@
+import ast
+import heapq
+from fractions import gcd
+
+class UnsupportedExpression(Exception):
+    "Raised for expressions which are not handled by ExpressionOptimizer."
+
+class ExpressionOptimizer:
+    """Common subexpression elimination and constant folding for the lists
+    of generated assignments which are substituted into the solver function
+    templates (e.g. steady_state_expressions and jacobian_expressions).
+
+    The right hand sides of the assignments are parsed into a directed
+    acyclic graph of sums and products of the variables (kf[0], theta[1],
+    s[0], ...), where identical subexpressions are the same node:
+
+        - integer constants are folded into the coefficients of the terms
+          (e.g. 0 + 1*(-2*x) - -1*y becomes -2*x + y).
+        - pairs of terms which occur in several sums and pairs of factors
+          which occur in several products are replaced by new nodes, the
+          most frequent pair first, until no pair is shared.
+        - nodes which are used more than once are evaluated once into a
+          temporary variable (prefix followed by a number) right before the
+          first line which needs them.
+        - terms with the same coefficient are summed before multiplying
+          by the coefficient.
+
+    Lines which are not single assignments to a name or an item
+    (e.g. s = [0]*2) are kept as they are and end the block of lines
+    between which subexpressions are shared, as does an assignment to a
+    variable which was already assigned. Assignments with expressions
+    which can not be parsed, or which fold to a constant, are also kept.
+
+    optimize(expressions): returns the optimized list of lines for a list
+        of lines of python code.
+    max_pair_terms: sums with more terms are not searched for shared pairs
+        of terms, since the number of pairs grows quadratically.
+    """
+    max_pair_terms = 40
+
+    def __init__(self,prefix='_cse'):
+        self.prefix = prefix
+        self.n_temporaries = 0
+
+    def optimize(self,expressions):
+        "Optimized list of lines for the list of lines expressions."
+        lines = []
+        block = []
+        assigned = set()
+        for line in expressions:
+            target = self.get_target(line)
+            if target is None or target in assigned:
+                lines += self.optimize_block(block)
+                block = []
+                assigned = set()
+            if target is None:
+                lines.append(line)
+            else:
+                block.append([target,line])
+                assigned.add(target)
+        lines += self.optimize_block(block)
+        return lines
+
+    def get_target(self,line):
+        """Source of the variable assigned by line, or None if line is not
+        a single assignment to a name or an item."""
+        try:
+            body = ast.parse(line).body
+        except SyntaxError: #e.g. indented lines or headers of loops
+            return None
+        if len(body) != 1 or not isinstance(body[0],ast.Assign):
+            return None
+        targets = body[0].targets
+        if len(targets) != 1 or not isinstance(
+                targets[0],(ast.Name,ast.Subscript)):
+            return None
+        try:
+            return self.source(targets[0])
+        except UnsupportedExpression:
+            return None
+
+    def optimize_block(self,block):
+        """Optimized lines for a list of [target,line] with assignments
+        which can share subexpressions."""
+        self._nodes = []
+        self._ids = {}
+        self._alias = {}
+        statements = []
+        for target,line in block:
+            try:
+                value = self.build(ast.parse(line).body[0].value)
+            except UnsupportedExpression:
+                statements.append([target,line,None])
+                continue
+            if not value[1]: #keep constants as they are
+                statements.append([target,line,None])
+            else:
+                statements.append([target,line,self.as_node(value)])
+
+        roots = [root for target,line,root in statements if root is not None]
+        self.pair_terms(roots)
+        self.pair_factors(roots)
+        self.merge_products(roots)
+
+        counts = self.count_references(roots)
+        self._temporaries = {}
+        self._hoisted = set([n for n in counts if counts[n] > 1 and
+            self._nodes[n][0] in ['add','mul','div','pow']])
+        lines = []
+        for target,line,root in statements:
+            if root is None:
+                lines.append(line)
+                continue
+            root = self.resolve(root)
+            lines += self.evaluate_dependencies(root)
+            if root in self._hoisted:
+                lines += self.evaluate_temporary(root)
+            lines.append(target+' = '+self.expression(root))
+        return lines
+
+    #parsing
+
+    def source(self,node):
+        "Source of the names, items and calls with constant arguments."
+        if isinstance(node,ast.Name):
+            return node.id
+        elif isinstance(node,ast.Num):
+            return repr(node.n)
+        elif isinstance(node,ast.Str):
+            return repr(node.s)
+        elif isinstance(node,ast.Attribute):
+            return self.source(node.value)+'.'+node.attr
+        elif (isinstance(node,ast.Subscript) and
+                isinstance(node.slice,ast.Index)):
+            return (self.source(node.value)+'['+
+                    self.source(node.slice.value)+']')
+        elif (isinstance(node,ast.Call) and not node.keywords and
+                not node.starargs and not node.kwargs and
+                False not in [isinstance(a,(ast.Num,ast.Str))
+                    for a in node.args]):
+            return (self.source(node.func)+'('+
+                    ', '.join([self.source(a) for a in node.args])+')')
+        raise UnsupportedExpression(ast.dump(node))
+
+    def node_id(self,node):
+        "Index of node, which is added to the graph if it is new."
+        key = node
+        if node[0] == 'mul':
+            key = ('mul',tuple(sorted(node[1])))
+        elif node[0] == 'add':
+            key = ('add',tuple(sorted(node[1])))
+        if key not in self._ids:
+            self._ids[key] = len(self._nodes)
+            self._nodes.append(node)
+        return self._ids[key]
+
+    def build(self,node):
+        """Parse the ast node into a sum of terms as (constant,terms) where
+        terms is a list of [node_id,coefficient] with integer constants and
+        coefficients."""
+        if isinstance(node,ast.Num):
+            n = node.n
+            if isinstance(n,float) and n.is_integer() and abs(n) < 2**53:
+                n = int(n)
+            if isinstance(n,(int,long)):
+                return (n,[])
+        if isinstance(node,ast.UnaryOp):
+            value = self.build(node.operand)
+            if isinstance(node.op,ast.USub):
+                return self.scale(value,-1)
+            elif isinstance(node.op,ast.UAdd):
+                return value
+            raise UnsupportedExpression(ast.dump(node))
+        elif isinstance(node,ast.BinOp):
+            left = self.build(node.left)
+            right = self.build(node.right)
+            if isinstance(node.op,ast.Add):
+                return self.add(left,right)
+            elif isinstance(node.op,ast.Sub):
+                return self.add(left,self.scale(right,-1))
+            elif isinstance(node.op,ast.Mult):
+                return self.multiply(left,right)
+            elif isinstance(node.op,ast.Div):
+                return self.divide(left,right)
+            elif isinstance(node.op,ast.Pow):
+                return self.power(left,right)
+            raise UnsupportedExpression(ast.dump(node))
+        return (0,[[self.node_id(('leaf',self.source(node))),1]])
+
+    def scale(self,value,c):
+        "Multiply the sum value by the integer c."
+        const,terms = value
+        if c == 0:
+            return (0,[])
+        return (const*c,[[n,k*c] for n,k in terms])
+
+    def add(self,a,b):
+        "Sum of the sums a and b."
+        terms = [[n,k] for n,k in a[1]]
+        index = dict([(n,i) for i,(n,k) in enumerate(terms)])
+        for n,k in b[1]:
+            if n in index:
+                terms[index[n]][1] += k
+            else:
+                index[n] = len(terms)
+                terms.append([n,k])
+        return (a[0]+b[0],[[n,k] for n,k in terms if k != 0])
+
+    def as_node(self,value):
+        "Node id of the sum value."
+        const,terms = value
+        if not terms:
+            return self.node_id(('num',const))
+        elif const == 0 and len(terms) == 1 and terms[0][1] == 1:
+            return terms[0][0]
+        terms = [tuple(t) for t in terms]
+        if const != 0:
+            terms.append((self.node_id(('num',1)),const))
+        return self.node_id(('add',tuple(terms)))
+
+    def as_scaled_node(self,value):
+        """Split the sum value into an integer coefficient and a node id
+        (None for constants)."""
+        const,terms = value
+        if not terms:
+            return const,None
+        elif const == 0 and len(terms) == 1:
+            return terms[0][1],terms[0][0]
+        return 1,self.as_node(value)
+
+    def factors(self,n):
+        "Factors of the node n."
+        if self._nodes[n][0] == 'mul':
+            return list(self._nodes[n][1])
+        return [n]
+
+    def multiply(self,a,b):
+        "Product of the sums a and b."
+        ca,na = self.as_scaled_node(a)
+        cb,nb = self.as_scaled_node(b)
+        if na is None:
+            return self.scale(b,ca)
+        elif nb is None:
+            return self.scale(a,cb)
+        n = self.node_id(('mul',tuple(self.factors(na)+self.factors(nb))))
+        return self.scale((0,[[n,1]]),ca*cb)
+
+    def divide(self,a,b):
+        "Quotient of the sums a and b."
+        if not b[1] and not a[1]: #integer division in python 2
+            raise UnsupportedExpression('division of constants')
+        ca,na = self.as_scaled_node(a)
+        if na is None:
+            ca,na = 1,self.as_node(a)
+        n = self.node_id(('div',na,self.as_node(b)))
+        return self.scale((0,[[n,1]]),ca)
+
+    def power(self,a,b):
+        "Sum a to the power b. Small integer powers become products."
+        if not a[1]:
+            raise UnsupportedExpression('power of a constant')
+        if not b[1] and 1 <= b[0] <= 4:
+            value = a
+            for i in range(b[0]-1):
+                value = self.multiply(value,a)
+            return value
+        n = self.node_id(('pow',self.as_node(a),self.as_node(b)))
+        return (0,[[n,1]])
+
+    #common subexpressions
+
+    def children(self,n):
+        "Node ids used to evaluate the node n."
+        node = self._nodes[n]
+        if node[0] == 'add':
+            return [self.resolve(m) for m,k in node[1]]
+        elif node[0] == 'mul':
+            return [self.resolve(m) for m in node[1]]
+        elif node[0] in ['div','pow']:
+            return [self.resolve(m) for m in node[1:]]
+        return []
+
+    def resolve(self,n):
+        "Node id which is used for n (after merging equal products)."
+        while n in self._alias:
+            n = self._alias[n]
+        return n
+
+    def reachable(self,roots,kind=None):
+        """Node ids needed to evaluate the roots (of the given kind) in the
+        order they are first needed."""
+        seen = set()
+        order = []
+        stack = [self.resolve(r) for r in reversed(roots)]
+        while stack:
+            n = stack.pop()
+            if n in seen:
+                continue
+            seen.add(n)
+            if kind is None or self._nodes[n][0] == kind:
+                order.append(n)
+            stack += list(reversed(self.children(n)))
+        return order
+
+    def count_references(self,roots):
+        "Number of times each node is used by the roots and other nodes."
+        counts = {}
+        for r in roots:
+            r = self.resolve(r)
+            counts[r] = counts.get(r,0) + 1
+        for n in self.reachable(roots):
+            for m in self.children(n):
+                counts[m] = counts.get(m,0) + 1
+        return counts
+
+    def replace_pairs(self,items,get_pairs,make_node,replace):
+        """Replace the most frequent pair which occurs in at least two of
+        the lists in items (dictionary of node id:list) by a new node until
+        no pair is shared. get_pairs(list) returns the pairs in a list,
+        make_node(pair) returns the id of the node for a pair and
+        replace(pair,list,new) returns the list with the pair replaced by
+        the node new."""
+        index = {}
+        node_pairs = {}
+        def add_pairs(n):
+            node_pairs[n] = get_pairs(items[n])
+            for p in node_pairs[n]:
+                index.setdefault(p,set()).add(n)
+        def remove_pairs(n):
+            for p in node_pairs.pop(n,[]):
+                index[p].discard(n)
+        for n in items:
+            add_pairs(n)
+        heap = [(-len(v),p) for p,v in index.items() if len(v) > 1]
+        heapq.heapify(heap)
+        while heap:
+            count,p = heapq.heappop(heap)
+            if len(index[p]) != -count:
+                if len(index[p]) > 1: #count changed since it was pushed
+                    heapq.heappush(heap,(-len(index[p]),p))
+                continue
+            new = make_node(p)
+            changed = []
+            for n in sorted(index[p]):
+                if n == new:
+                    continue
+                remove_pairs(n)
+                items[n] = replace(p,items[n],new)
+                add_pairs(n)
+                changed.append(n)
+            for n in changed:
+                for q in node_pairs[n]:
+                    if len(index[q]) > 1:
+                        heapq.heappush(heap,(-len(index[q]),q))
+
+    def pair_terms(self,roots):
+        """Factor out pairs of terms (with the same ratio of coefficients)
+        which occur in several sums."""
+        sums = dict([(n,list(self._nodes[n][1]))
+            for n in self.reachable(roots,'add')])
+        def make_node(pair):
+            return self.node_id(('add',pair))
+        def get_pairs(terms):
+            if len(terms) > self.max_pair_terms:
+                return []
+            pairs = []
+            for i,(n1,k1) in enumerate(terms):
+                for n2,k2 in terms[i+1:]:
+                    if n2 < n1:
+                        n1,k1,n2,k2 = n2,k2,n1,k1
+                    g = gcd(abs(k1),abs(k2))*cmp(k1,0)
+                    pairs.append(((n1,k1/g),(n2,k2/g)))
+            return pairs
+        def replace(pair,terms,new):
+            (n1,k1),(n2,k2) = pair
+            g = dict(terms)[n1]/k1
+            return [t for t in terms if t[0] not in [n1,n2]]+[(new,g)]
+        self.replace_pairs(sums,get_pairs,make_node,replace)
+        for n in sums:
+            self._nodes[n] = ('add',tuple(sums[n]))
+
+    def pair_factors(self,roots):
+        "Factor out pairs of factors which occur in several products."
+        products = dict([(n,list(self._nodes[n][1]))
+            for n in self.reachable(roots,'mul')])
+        def make_node(pair):
+            return self.node_id(('mul',pair))
+        def get_pairs(factors):
+            pairs = set()
+            for i,a in enumerate(factors):
+                for b in factors[i+1:]:
+                    pairs.add(tuple(sorted([a,b])))
+            return sorted(pairs)
+        def replace(pair,factors,new):
+            a,b = pair
+            factors = list(factors)
+            while a in factors:
+                factors.remove(a)
+                if b not in factors:
+                    factors.append(a)
+                    break
+                factors.remove(b)
+                factors.append(new)
+            return factors
+        self.replace_pairs(products,get_pairs,make_node,replace)
+        for n in products:
+            self._nodes[n] = ('mul',tuple(products[n]))
+
+    def merge_products(self,roots):
+        """Use one node for products which became equal by factoring out
+        pairs, and the remaining factor (term) for products (sums) which
+        were reduced to one."""
+        seen = {}
+        for n in self.reachable(roots):
+            node = self._nodes[n]
+            if node[0] == 'add':
+                if len(node[1]) == 1 and node[1][0][1] == 1:
+                    self._alias[n] = node[1][0][0]
+            elif node[0] == 'mul':
+                if len(node[1]) == 1:
+                    self._alias[n] = node[1][0]
+                    continue
+                key = tuple(sorted([self.resolve(m) for m in node[1]]))
+                if key in seen:
+                    self._alias[n] = seen[key]
+                else:
+                    seen[key] = n
+
+    #code generation
+
+    def evaluate_dependencies(self,n):
+        "Lines evaluating the temporary variables needed by node n."
+        lines = []
+        for m in self.children(n):
+            if m in self._temporaries:
+                continue
+            lines += self.evaluate_dependencies(m)
+            if m in self._hoisted:
+                lines += self.evaluate_temporary(m)
+        return lines
+
+    def evaluate_temporary(self,n):
+        "Line assigning the node n to a new temporary variable."
+        name = self.prefix+str(self.n_temporaries)
+        self.n_temporaries += 1
+        line = name+' = '+self.expression(n)
+        self._temporaries[n] = name
+        return [line]
+
+    def term(self,n):
+        "Source of node n as a factor of a product."
+        if n in self._temporaries:
+            return self._temporaries[n]
+        elif self._nodes[n][0] in ['add','div']:
+            return '('+self.expression(n)+')'
+        return self.expression(n)
+
+    def summand(self,n):
+        "Source of node n as a term of a sum."
+        n = self.resolve(n)
+        if n not in self._temporaries and self._nodes[n][0] == 'add':
+            return '('+self.expression(n)+')'
+        return self.expression(n)
+
+    def expression(self,n):
+        "Source of node n (inlining the nodes which are not temporaries)."
+        n = self.resolve(n)
+        if n in self._temporaries:
+            return self._temporaries[n]
+        node = self._nodes[n]
+        kind = node[0]
+        if kind == 'leaf':
+            return node[1]
+        elif kind == 'num':
+            return str(node[1])
+        elif kind == 'mul':
+            return '*'.join([self.term(self.resolve(m)) for m in node[1]])
+        elif kind == 'div':
+            a,b = [self.resolve(m) for m in node[1:]]
+            denominator = self.term(b)
+            if self._nodes[b][0] == 'mul' and b not in self._temporaries:
+                denominator = '('+denominator+')'
+            return self.term(a)+'/'+denominator
+        elif kind == 'pow':
+            a,b = [self.resolve(m) for m in node[1:]]
+            base = self.term(a)
+            if self._nodes[a][0] == 'mul' and a not in self._temporaries:
+                base = '('+base+')'
+            exponent = self.term(b)
+            if self._nodes[b][0] != 'leaf' and b not in self._temporaries:
+                exponent = '('+exponent+')'
+            return base+'**'+exponent
+        elif kind == 'add':
+            one = self.node_id(('num',1))
+            const = 0
+            groups = []
+            group_index = {}
+            for m,k in node[1]:
+                if m == one:
+                    const += k
+                    continue
+                if abs(k) not in group_index:
+                    group_index[abs(k)] = len(groups)
+                    groups.append([abs(k),[]])
+                groups[group_index[abs(k)]][1].append([cmp(k,0),m])
+            parts = []
+            for k,terms in groups:
+                if k == 1:
+                    parts += [[sign,self.summand(m)] for sign,m in terms]
+                elif len(terms) == 1:
+                    sign,m = terms[0]
+                    parts.append([sign,str(k)+'*'+self.term(self.resolve(m))])
+                else:
+                    outer = terms[0][0]
+                    inner = [[sign*outer,self.summand(m)]
+                            for sign,m in terms]
+                    parts.append([outer,str(k)+'*('+
+                        self.join_terms(inner)+')'])
+            if const:
+                parts.append([cmp(const,0),str(abs(const))])
+            return self.join_terms(parts)
+
+    def join_terms(self,parts):
+        "Source of the sum of the list of [sign,source]."
+        if not parts:
+            return '0'
+        parts = sorted(parts,key=lambda p: -p[0]) #start with a positive term
+        text = ''
+        for i,(sign,part) in enumerate(parts):
+            if i == 0:
+                text += ['','-'][sign < 0]+part
+            else:
+                text += [' + ',' - '][sign < 0]+part
+        return text
@@ -1,7 +1,7 @@
 from solver_base import *
 from catmap.data import templates
-from copy import copy
 import mpmath as mp
+import re
 from catmap.functions import numerical_jacobian
 
 class MeanFieldSolver(SolverBase):
@@ -13,12 +13,25 @@ class MeanFieldSolver(SolverBase):
         defaults = dict(
                 tolerance = 1e-35,
                 perturbation_size = 1e-14,
+                sensitivity_mode = 'numerical',
                 )
         self._rxm.update(defaults)
         self._log_strings = {
                             'jacobian_fail':
                             "stagnated or diverging (residual = ${resid})."+\
                             " Assuming Jacobian is 0.",
+                            'sensitivity_fail':
+                            "singular steady-state Jacobian or coverages"+\
+                            " held at their bounds. Using numerical "+\
+                            "sensitivities.",
+                            'order_fail':
+                            "singular steady-state Jacobian or coverages"+\
+                            " held at their bounds. Solving the steady "+\
+                            "state at pressures scaled by exp(+-${epsilon}).",
+                            'activation_fail':
+                            "singular steady-state Jacobian or coverages"+\
+                            " held at their bounds. Solving the steady "+\
+                            "state at T+-${dT} K.",
                             }
     
     def get_rxn_rates(self,coverages,rate_constants):
@@ -78,8 +91,9 @@ class MeanFieldSolver(SolverBase):
         self._turnover_frequency = turnover_freq
         return turnover_freq
 
-    def get_selectivity(self,rxn_parameters):
-        tofs = self.get_turnover_frequency(rxn_parameters)
+    def get_selectivity(self,rxn_parameters,verify_coverages=True):
+        tofs = self.get_turnover_frequency(rxn_parameters,
+                verify_coverages=verify_coverages)
         if self.products is None:
             self.products = [g for g,r in zip(self.gas_names,tofs) if r >0]
         if self.reactants is None:
@@ -107,7 +121,7 @@ class MeanFieldSolver(SolverBase):
         kT = self._kB*self.temperature
         eps = self._mpfloat(self.perturbation_size)
         try:
-            dRdG = numerical_jacobian(self.get_turnover_frequency,rxn_parameters,self._matrix,eps)
+            dRdG = self.get_output_jacobian(self.get_turnover_frequency,rxn_parameters,eps)
         except ValueError, strerror:
             resid = str(strerror).rsplit('=',1)[1]
             resid = resid.replace(')','')
@@ -126,6 +140,46 @@ class MeanFieldSolver(SolverBase):
 		DRC.append([float(Jj/ti) for Jj in Ji])
         return DRC
 
+    def get_output_jacobian(self,output_fn,rxn_parameters,h):
+        """Jacobian of the steady-state output_fn(rxn_parameters) (e.g. 
+        get_turnover_frequency) with respect to the reaction parameters. 
+        If sensitivity_mode is 'numerical' the steady state is solved 
+        again for each perturbed parameter. If it is 'implicit' the 
+        coverages are moved along their derivatives from 
+        get_coverage_sensitivity instead, so output_fn is only evaluated 
+        at fixed coverages (verify_coverages=False). These derivatives are 
+        taken by central differences with a step of the cube root of the 
+        machine epsilon rather than h, which keeps the error small where 
+        large forward and reverse rates cancel. If the coverage 
+        derivatives cannot be found (see solve_sensitivity_equations) the 
+        'numerical' mode is used."""
+        if self.sensitivity_mode == 'implicit':
+            if self._mpfloat == float:
+                h_c = np.finfo(float).eps**(1./3)
+            else:
+                h_c = mp.cbrt(mp.eps)
+            coverages = list(self.get_coverage(rxn_parameters,
+                c0=self._coverage))
+            try:
+                dcdG = self.get_coverage_sensitivity(
+                        rxn_parameters,coverages,h_c)
+            except ZeroDivisionError:
+                self.log('sensitivity_fail')
+            else:
+                G0 = list(rxn_parameters)
+                def f(G):
+                    dG = [Gj-G0j for Gj,G0j in zip(G,G0)]
+                    self._coverage = [ci + sum([dci*dGj 
+                        for dci,dGj in zip(dcdG_i,dG)])
+                        for ci,dcdG_i in zip(coverages,dcdG)]
+                    return output_fn(G,verify_coverages=False)
+                try:
+                    return numerical_jacobian(f,rxn_parameters,
+                            self._matrix,h_c,central=True)
+                finally:
+                    self._coverage = coverages
+        return numerical_jacobian(output_fn,rxn_parameters,self._matrix,h)
+
     def get_interacting_energies(self,rxn_parameters):
         all_ads = self.adsorbate_names + self.transition_state_names
         N_ads = len(all_ads)
@@ -139,50 +193,198 @@ class MeanFieldSolver(SolverBase):
         kT = self._kB*self.temperature
         eps = self._mpfloat(self.perturbation_size)
         try:
-            dSdG = numerical_jacobian(self.get_selectivity,rxn_parameters,self._matrix,eps)
+            dSdG = self.get_output_jacobian(self.get_selectivity,rxn_parameters,eps)
         except ValueError,strerror:
             resid = str(strerror).rsplit('=',1)[1]
             resid = resid.replace(')','')
             resid.strip()
             self.log('jacobian_fail',resid=resid)
-            dRdG = np.zeros((len(self.gas_names),len(self.adsorbate_names+self.transition_state_names)))
+            dSdG = np.zeros((len(self.gas_names),len(self.adsorbate_names+self.transition_state_names)))
 
         s0 = self.get_selectivity(rxn_parameters)
         dSdG *= -kT
         dSdG = dSdG.tolist()
         DSC = []
         for si, Ji in zip(s0,dSdG):
-            DSC.append([float(Jj/si) for Jj in Ji])
+            if si == 0:
+                DSC.append([0.0]*len(Ji))
+            else:
+                DSC.append([float(Jj/si) for Jj in Ji])
         return DSC
         
     def get_rxn_order(self,rxn_parameters,epsilon=1e-10):
-        current_tofs = self.get_turnover_frequency(rxn_parameters)
-        current_Ps = [p for p in self.gas_pressures]
-        DRC = []
-
-        for i,p in enumerate(current_Ps):
-            new_p = copy(current_Ps)
-            new_p[i] = current_Ps[i]*(1+epsilon)
-            self._rxm.gas_pressures = new_p ##HACK
-            #setting self.gas_pressures = new_p inexplicably breaks the solver.
-            new_tofs = self.get_turnover_frequency(rxn_parameters)
-            DRC_i = []
-            for j,old_tof,new_tof,gas in zip(
-                    range(0,len(current_tofs)),current_tofs,new_tofs,self.gas_names):
-                if old_tof == 0:
-                    if new_tof == 0:
-                        dTOF = 0
-                    else:
-                        dTOF = (new_tof-old_tof)/new_tof
-                else:
-                    dTOF = (new_tof-old_tof)/old_tof
-                dP = (new_p[i] - current_Ps[i])/current_Ps[i]
-                DRC_i.append(float(dTOF/dP))
-            DRC.append(DRC_i)
-        self._rxm.gas_pressures = current_Ps ##HACK
-        #setting self.gas_pressures = current_Ps inexplicably breaks the solver.
-        self._rxn_order = DRC
-        return DRC
+        """Reaction orders dln(TOF_j)/dln(p_i) from the implicit function 
+        theorem, without solving the steady state again. The rates are 
+        proportional to the pressures in each direction, so at fixed 
+        coverages dr/dln(p_i) is the forward (reverse) rate times the 
+        number of gas i molecules in the initial (final) state. The 
+        change of the coverages is included by 
+        get_implicit_rate_derivatives, so the cost does not grow with the 
+        number of gases. Where the implicit derivatives do not hold (e.g. 
+        coverages held at their bounds) the steady state is solved again 
+        at pressures scaled by exp(+-epsilon) instead (see 
+        get_numerical_rxn_order)."""
+        tofs = self.get_turnover_frequency(rxn_parameters)
+        coverages = list(self._coverage)
+        forward_rates, reverse_rates = self.get_directional_rates(
+                rxn_parameters,coverages)
+
+        drdlnp = []
+        for rxn,rf,rr in zip(self.elementary_rxns,forward_rates,reverse_rates):
+            drdlnp.append([rxn[0].count(gas)*rf - rxn[-1].count(gas)*rr 
+                for gas in self.gas_names])
+        try:
+            drdlnp = self.get_implicit_rate_derivatives(
+                    rxn_parameters,coverages,drdlnp)
+        except ZeroDivisionError:
+            orders = self.get_numerical_rxn_order(rxn_parameters,epsilon)
+        else:
+            orders = []
+            for i,gas in enumerate(self.gas_names):
+                dtofs = self.get_turnover_frequency(rxn_parameters,
+                        rates=[dr[i] for dr in drdlnp])
+                orders.append([float(dt/t) if t != 0 else 0.0 
+                    for dt,t in zip(dtofs,tofs)])
+        self._turnover_frequency = tofs
+        self._rxn_order = orders
+        return orders
+
+    def get_numerical_rxn_order(self,rxn_parameters,epsilon=1e-10):
+        """Reaction orders from central differences of ln|TOF_j| with the 
+        steady state solved again with the pressure of each gas scaled by 
+        exp(+-epsilon). Gases whose turnover frequency is zero or changes 
+        sign, or points where the steady state is not found, give NaN."""
+        self.log('order_fail',epsilon=epsilon)
+        ln = self._math.log
+        pressures = list(self.gas_pressures)
+        coverages = list(self._coverage)
+        orders = []
+        try:
+            for i,gas in enumerate(self.gas_names):
+                tofs = []
+                for sign in [1,-1]:
+                    p = list(pressures)
+                    p[i] = pressures[i]*self._math.exp(sign*epsilon)
+                    self.gas_pressures = p
+                    tofs.append(self.get_turnover_frequency(rxn_parameters))
+                    self._coverage = coverages
+                orders.append([float((ln(abs(tp))-ln(abs(tm)))/(2*epsilon)) 
+                    if tp*tm > 0 else float('nan') 
+                    for tp,tm in zip(*tofs)])
+        except ValueError:
+            orders = [[float('nan')]*len(self.gas_names) 
+                    for gas in self.gas_names]
+        finally:
+            self.gas_pressures = pressures
+            self._coverage = coverages
+            self.get_rate_constants(rxn_parameters,coverages)
+        return orders
+
+    def get_apparent_activation_energy(self,rxn_parameters):
+        """Apparent activation energies kB*T^2*dln(TOF_j)/dT of the gases 
+        from the implicit function theorem, without solving the steady 
+        state at other temperatures. At fixed coverages dr/dT follows from 
+        the temperature derivatives of the rate constants 
+        (get_rate_constant_temperature_derivatives), and the change of the 
+        coverages is included by get_implicit_rate_derivatives. Where the 
+        implicit derivatives do not hold (e.g. coverages held at their 
+        bounds) the steady state is solved again at T+-dT instead (see 
+        get_numerical_apparent_activation_energy)."""
+        tofs = self.get_turnover_frequency(rxn_parameters)
+        coverages = list(self._coverage)
+        dlnkdT = self.get_rate_constant_temperature_derivatives(
+                rxn_parameters,coverages)
+        forward_rates, reverse_rates = self.get_directional_rates(
+                rxn_parameters,coverages)
+        n_rxns = len(forward_rates)
+
+        drdT = [[dlnkf*rf - dlnkr*rr] for dlnkf,dlnkr,rf,rr in zip(
+            dlnkdT[:n_rxns],dlnkdT[n_rxns:],forward_rates,reverse_rates)]
+        try:
+            drdT = self.get_implicit_rate_derivatives(
+                    rxn_parameters,coverages,drdT)
+        except ZeroDivisionError:
+            Ea = self.get_numerical_apparent_activation_energy(
+                    rxn_parameters)
+        else:
+            kT2 = self._kB*self.temperature**2
+            dtofs = self.get_turnover_frequency(rxn_parameters,
+                    rates=[dr[0] for dr in drdT])
+            Ea = [float(kT2*dt/t) if t != 0 else 0.0 
+                    for dt,t in zip(dtofs,tofs)]
+        self._turnover_frequency = tofs
+        self._apparent_activation_energy = Ea
+        return Ea
+
+    def get_numerical_apparent_activation_energy(self,rxn_parameters,
+            dT=0.01):
+        """Apparent activation energies from central differences of 
+        ln|TOF_j| with the steady state solved again at T+-dT (see 
+        get_temperature_shifted_turnover_frequency). Gases whose turnover 
+        frequency is zero or changes sign, or points where the steady state 
+        is not found, give NaN."""
+        self.log('activation_fail',dT=dT)
+        ln = self._math.log
+        kT2 = self._kB*self.temperature**2
+        try:
+            tofs_p = self.get_temperature_shifted_turnover_frequency(
+                    rxn_parameters,dT)
+            tofs_m = self.get_temperature_shifted_turnover_frequency(
+                    rxn_parameters,-dT)
+        except ValueError:
+            return [float('nan')]*len(self.gas_names)
+        return [float(kT2*(ln(abs(tp))-ln(abs(tm)))/(2*dT)) if tp*tm > 0 
+                else float('nan') for tp,tm in zip(tofs_p,tofs_m)]
+
+    def get_directional_rates(self,rxn_parameters,coverages):
+        """Forward and reverse rates of the elementary steps at coverages, 
+        such that the net rates are forward_rates - reverse_rates."""
+        self.get_rate_constants(rxn_parameters,coverages)
+        kf = list(self._kf)
+        kr = list(self._kr)
+        zeros = [self._mpfloat(0)]*len(kf)
+        forward_rates = self.get_rxn_rates(coverages,kf+zeros)
+        reverse_rates = [-r for r in self.get_rxn_rates(coverages,zeros+kr)]
+        return forward_rates, reverse_rates
+
+    def get_implicit_rate_derivatives(self,rxn_parameters,coverages,drdx):
+        """Derivatives of the steady-state rates with respect to some 
+        parameters x, given the derivatives drdx (a row for each elementary 
+        step) at fixed coverages. The coverages change by 
+        dtheta/dx = -J^-1 df/dx, where df/dx follows from drdx with the 
+        stoichiometry of rate_equations. This is solved for all parameters 
+        with one factorization of the steady-state Jacobian 
+        (solve_sensitivity_equations), which raises ZeroDivisionError if 
+        the derivatives do not hold. The change of the rates with coverage 
+        is found by central differences."""
+        n_x = len(drdx[0]) if drdx else 0
+        dfdx = []
+        for ads in self.adsorbate_names:
+            dfdx_i = [0]*n_x
+            for rxn,drdx_j in zip(self.elementary_rxns,drdx):
+                rxnOrder = [o for o in 
+                        [-1*rxn[0].count(ads), rxn[-1].count(ads)] if o]
+                if rxnOrder:
+                    dfdx_i = [df + rxnOrder[0]*dr 
+                            for df,dr in zip(dfdx_i,drdx_j)]
+            dfdx.append(dfdx_i)
+
+        dcdx = self.solve_sensitivity_equations(coverages,dfdx)
+
+        if self._mpfloat == float:
+            h = np.finfo(float).eps**(1./3)
+        else:
+            h = mp.cbrt(mp.eps)
+        def r(theta):
+            theta = list(theta)
+            return self.get_rxn_rates(theta,
+                    self.get_rate_constants(rxn_parameters,theta))
+        drdc = numerical_jacobian(r,coverages,self._matrix,h,central=True)
+        self.get_rate_constants(rxn_parameters,coverages)
+
+        return [[drdx[k][i] + sum([drdc[k,a]*dcdx[a][i] 
+            for a in range(len(coverages))]) for i in range(n_x)]
+            for k in range(len(drdx))]
 
     def summary_text(self):
         return ''
@@ -410,6 +612,187 @@ class MeanFieldSolver(SolverBase):
                 J_strings.append(J_str)
         return J_strings
 
+    def sparse_jacobian_equations(self,adsorbate_interactions=True):
+        """Composes analytical expressions for the non-zero elements of the 
+        Jacobian matrix (see jacobian_equations). The expressions are 
+        assigned to the list J_data, and the rows and columns of the 
+        elements are defined as the lists J_rows and J_cols.
+        """
+        J_strings = []
+        J_rows = []
+        J_cols = []
+        for J_str in self.jacobian_equations(adsorbate_interactions):
+            match = re.match('J\[(\d+)\]\[(\d+)\] = 0(.*)$',J_str)
+            if not match:
+                J_strings.append(J_str)
+                continue
+            i, j, terms = match.groups()
+            if terms:
+                J_strings.append(
+                        'J_data['+str(len(J_rows))+'] = 0'+terms)
+                J_rows.append(int(i))
+                J_cols.append(int(j))
+        J_strings = ['J_rows = '+repr(J_rows),
+                'J_cols = '+repr(J_cols),
+                'J_data = [0]*'+str(len(J_rows))] + J_strings
+        return J_strings
+
+    def kernel_tables(self):
+        """Tables of the stoichiometry of the elementary steps which are 
+        used by the loop-based expressions (see loop_rate_equations):
+
+        site_table: [total,[adsorbate indices]] for each site
+        rate_table: [forward,reverse] terms of each step, where each term 
+            is [gas indices,adsorbate indices,site indices,derivatives] and 
+            derivatives is a list of [j,[[m,d],...]] such that the 
+            derivative of the m'th coverage factor (adsorbates followed by 
+            sites) wrt theta[j] is d
+        stoich_table: [[step index,coefficient],...] of the rates in 
+            dtheta_dt for each adsorbate
+        rxn_stoich_table: [[adsorbate index,coefficient],...] of each step
+        """
+        ads_sites = [self.site_names.index(self.species_definitions[a]['site'])
+                for a in self.adsorbate_names]
+
+        site_table = []
+        for i,site in enumerate(self.site_names):
+            total = self._mpfloat(self.species_definitions[site]['total'])
+            site_table.append([total,
+                [j for j,sj in enumerate(ads_sites) if sj == i]])
+
+        def term(species_list):
+            gas_idxs = [self.gas_names.index(gas) 
+                    for gas in species_list if gas in self.gas_names]
+            ads_idxs = [self.adsorbate_names.index(ads) 
+                    for ads in species_list if ads in self.adsorbate_names]
+            site_idxs = [self.site_names.index(s) 
+                    for s in species_list if s in self.site_names]
+            if len(gas_idxs+ads_idxs+site_idxs) != len(species_list):
+                raise ValueError('Undefined species in '+','.join(species_list))
+            derivs = []
+            for j,sj in enumerate(ads_sites):
+                factors = [[m,1] for m,a in enumerate(ads_idxs) if a == j]
+                factors += [[len(ads_idxs)+m,-1] 
+                        for m,si in enumerate(site_idxs) if si == sj]
+                if factors:
+                    derivs.append([j,factors])
+            return [gas_idxs,ads_idxs,site_idxs,derivs]
+
+        rate_table = [[term(rxn[0]),term(rxn[-1])] 
+                for rxn in self.elementary_rxns]
+
+        stoich_table = []
+        rxn_stoich_table = [[] for rxn in self.elementary_rxns]
+        for i,ads in enumerate(self.adsorbate_names):
+            stoich = []
+            for j,rxn in enumerate(self.elementary_rxns):
+                rxnCounts = [-1*rxn[0].count(ads), 1*rxn[-1].count(ads)]
+                rxnOrder = [o for o in rxnCounts if o]
+                if rxnOrder:
+                    stoich.append([j,rxnOrder[0]])
+                    rxn_stoich_table[j].append([i,rxnOrder[0]])
+            stoich_table.append(stoich)
+
+        return dict(site_table=site_table, rate_table=rate_table,
+                stoich_table=stoich_table, rxn_stoich_table=rxn_stoich_table)
+
+    def loop_rate_equations(self):
+        """Compose expressions for the reaction rates and change of surface 
+        species wrt time (dc/dt) as loops over the tables from 
+        kernel_tables. Equivalent to rate_equations, but the length of the 
+        expressions does not grow with the number of elementary steps. 
+        Assumes the same variables as rate_equations."""
+        tables = self.kernel_tables()
+        return [
+            'site_table = '+repr(tables['site_table']),
+            'rate_table = '+repr(tables['rate_table']),
+            'stoich_table = '+repr(tables['stoich_table']),
+            's = [0]*len(site_table)',
+            'for i,(total,idxs) in enumerate(site_table):',
+            '    s[i] = total',
+            '    for a in idxs:',
+            '        s[i] = s[i] - theta[a]',
+            'for k,terms in enumerate(rate_table):',
+            '    r_k = [kf[k],kr[k]]',
+            '    for n,(gas,ads,sites,derivs) in enumerate(terms):',
+            '        for g in gas:',
+            '            r_k[n] = r_k[n]*p[g]',
+            '        for a in ads:',
+            '            r_k[n] = r_k[n]*theta[a]',
+            '        for x in sites:',
+            '            r_k[n] = r_k[n]*s[x]',
+            '    r[k] = r_k[0] - r_k[1]',
+            'for i,stoich in enumerate(stoich_table):',
+            '    dtheta_dt[i] = 0',
+            '    for k,c in stoich:',
+            '        dtheta_dt[i] = dtheta_dt[i] + c*r[k]',
+            ]
+
+    def loop_jacobian_equations(self,adsorbate_interactions=True,
+            sparse=False):
+        """Compose expressions for the Jacobian matrix as loops over the 
+        tables from kernel_tables. Equivalent to jacobian_equations (or 
+        sparse_jacobian_equations if sparse is True), but the length of the 
+        expressions does not grow with the number of elementary steps. 
+        Assumes the same variables as jacobian_equations."""
+        tables = self.kernel_tables()
+        J_strings = [
+            'site_table = '+repr(tables['site_table']),
+            'rate_table = '+repr(tables['rate_table']),
+            'rxn_stoich_table = '+repr(tables['rxn_stoich_table']),
+            's = [0]*len(site_table)',
+            'for i,(total,idxs) in enumerate(site_table):',
+            '    s[i] = total',
+            '    for a in idxs:',
+            '        s[i] = s[i] - theta[a]',
+            'J = [[0 for i in range(n_adsorbates)] for j in range(n_adsorbates)]',
+            'for k,terms in enumerate(rate_table):',
+            '    for n,(gas,ads,sites,derivs) in enumerate(terms):',
+            '        sign = [1,-1][n]',
+            '        prefactor = [kf,kr][n][k]',
+            '        for g in gas:',
+            '            prefactor = prefactor*p[g]',
+            '        factors = [theta[a] for a in ads] + [s[x] for x in sites]',
+            '        for j,dfactors in derivs:',
+            '            dterm = 0',
+            '            for m,d in dfactors:',
+            '                dterm_m = d*prefactor',
+            '                for l,factor in enumerate(factors):',
+            '                    if l != m:',
+            '                        dterm_m = dterm_m*factor',
+            '                dterm = dterm + dterm_m',
+            '            for i,c in rxn_stoich_table[k]:',
+            '                J[i][j] = J[i][j] + sign*c*dterm',
+            ]
+        if adsorbate_interactions == True:
+            J_strings += [
+            '        term = prefactor/kBT',
+            '        for factor in factors:',
+            '            term = term*factor',
+            '        dE = [dEf,dEr][n][k]',
+            '        for j in range(n_adsorbates):',
+            '            for i,c in rxn_stoich_table[k]:',
+            '                J[i][j] = J[i][j] + sign*c*term*dE[j]',
+            ]
+
+        if sparse:
+            pattern = set()
+            for k,terms in enumerate(tables['rate_table']):
+                for gas,ads,sites,derivs in terms:
+                    if adsorbate_interactions == True:
+                        cols = range(len(self.adsorbate_names))
+                    else:
+                        cols = [j for j,dfactors in derivs]
+                    for i,c in tables['rxn_stoich_table'][k]:
+                        pattern.update([(i,j) for j in cols])
+            pattern = sorted(pattern)
+            J_strings += [
+            'J_rows = '+repr([i for i,j in pattern]),
+            'J_cols = '+repr([j for i,j in pattern]),
+            'J_data = [J[i][j] for i,j in zip(J_rows,J_cols)]',
+            ]
+        return J_strings
+
     def reaction_energy_equations(self,adsorbate_interactions=True):
         """Composes a list of analytical expressions which give the reaction 
         and activation energies for elementary steps. Note that while this 
@@ -3,6 +3,9 @@ from catmap.model import ReactionModel
 from catmap import ReactionModelWrapper
 import numpy as np
 import mpmath as mp
+import warnings
+from collections import OrderedDict
+from scipy.linalg import lu_factor, lu_solve
 
 class SolverBase(ReactionModelWrapper):
     def __init__(self,reaction_model=ReactionModel()):
@@ -68,6 +71,11 @@ class SolverBase(ReactionModelWrapper):
             self._rxn_order = self.get_rxn_order(rxn_parameters)
             self.output_labels['rxn_order'] = [self.gas_names,self.gas_names]
 
+        if 'apparent_activation_energy' in self.output_variables:
+            self._apparent_activation_energy = \
+                    self.get_apparent_activation_energy(rxn_parameters)
+            self.output_labels['apparent_activation_energy'] = self.gas_names
+
         if 'interacting_energy' in self.output_variables:
             self._interacting_energy = self.get_interacting_energies(rxn_parameters)
             self.output_labels['interacting_energy'] = self.adsorbate_names+self.transition_state_names
@@ -108,6 +116,54 @@ class SolverBase(ReactionModelWrapper):
                 self.output_labels['equilibrium_constant'] = self.elementary_rxns
 
 
+class MemoCache:
+    """Cache of at most capacity items which discards the least recently 
+    used item when it is full.
+
+    get(key,default): value for key, or default if key is not cached.
+    hits, misses: number of calls of get which found or did not find the 
+        key since the cache was made or cleared.
+    statistics(): dictionary of the hits, misses, size and capacity.
+    """
+    def __init__(self,capacity=10000):
+        self.capacity = capacity
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self,key):
+        return key in self._data
+
+    def get(self,key,default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value #most recently used
+        self.hits += 1
+        return value
+
+    def __setitem__(self,key,value):
+        if self.capacity <= 0:
+            return
+        self._data.pop(key,None)
+        self._data[key] = value
+        while len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def statistics(self):
+        return {'hits':self.hits,'misses':self.misses,
+                'size':len(self._data),'capacity':self.capacity}
+
 class NewtonRoot:
     """
     Hacked from MDNewton in mpmath/calculus/optimization.py in order
@@ -127,6 +183,19 @@ class NewtonRoot:
     The function to calculate the Jacobian matrix can be given using the
     keyword 'J'. Otherwise it will be calculated numerically.
 
+    Use the 'mixed_precision' keyword to solve for the Newton steps of square 
+    systems with at least min_mixed_precision_size equations using a float64 
+    LU factorization of the Jacobian and iterative refinement at the full 
+    precision of the Jacobian (see refined_solve).
+
+    Use the 'trust_region' keyword to control the steps with a dogleg 
+    trust region (see dogleg_iterations) rather than by halving the Newton 
+    step.
+
+    Use the 'jacobian_update' keyword ('chord' or 'broyden') to re-use the 
+    factorization of the Jacobian over several steps rather than evaluating 
+    it at every step (see quasi_newton_iterations).
+
     Please note that this method converges only locally. Especially for high-
     dimensional systems it is not trivial to find a good starting point being
     close enough to the root.
@@ -142,6 +211,18 @@ class NewtonRoot:
 
     maxsteps = 10
 
+    #smallest system for which mixed precision steps are faster than
+    #solving at full precision
+    min_mixed_precision_size = 12
+
+    #smallest ratio of the actual and predicted reduction of |f|^2 for 
+    #accepting a trust-region step
+    min_trust_ratio = 1e-4
+
+    #largest ratio of the new and old residual norm for re-using the 
+    #Jacobian in the next quasi-Newton step
+    jacobian_reuse_ratio = 0.1
+
     def __init__(self, f, x0, matrix, mpfloat, Axb_solver, **kwargs):
         self._matrix = matrix
         self._mpfloat = mpfloat
@@ -196,8 +277,31 @@ class NewtonRoot:
         self.norm = kwargs['norm']
         self.verbose = kwargs['verbose']
         self.max_damping = 10
+        self.mixed_precision = kwargs.get('mixed_precision',False)
+        self.trust_region = kwargs.get('trust_region',False)
+        self.jacobian_update = kwargs.get('jacobian_update',None)
+        if self.jacobian_update not in [None,'chord','broyden']:
+            raise ValueError('Unknown jacobian_update: '+
+                    str(self.jacobian_update))
+        self.max_refinements = 10
+        self._lu = None
 
     def __iter__(self):
+        if self.trust_region:
+            return self.dogleg_iterations()
+        if self.jacobian_update:
+            return self.quasi_newton_iterations()
+        return self.newton_iterations()
+
+    def newton_step(self, Jx, fxn):
+        "Solve Jx*s = fxn for the Newton step s."
+        if (self.mixed_precision and getattr(Jx,'rows',None) == 
+                getattr(Jx,'cols',None) and
+                Jx.rows >= self.min_mixed_precision_size):
+            return self.refined_solve(Jx, fxn)
+        return self._Axb(Jx, fxn)
+
+    def newton_iterations(self):
         f = self.f
         x0 = self.constraint(self.x0)
         norm = self.norm
@@ -211,7 +315,7 @@ class NewtonRoot:
             fxn = -fx
             Jx = J(x0)
             try:
-                s = self._Axb(Jx, fxn)
+                s = self.newton_step(Jx, fxn)
             except ZeroDivisionError:
                 cancel = True
                 break
@@ -238,3 +342,261 @@ class NewtonRoot:
                 x1 = x0 + l*s
             yield (x0, fxnorm)
 
+    def quasi_newton_iterations(self):
+        """Newton's method which re-uses the factorization of the Jacobian 
+        (see factorize) over several steps. With jacobian_update = 'chord' 
+        the steps are solved with the last evaluated Jacobian, and with 
+        'broyden' the inverse of the Jacobian is also corrected by Broyden's 
+        rank-one update after each step. The updates are applied to the 
+        solution of the factorized system (Sherman-Morrison), so they cost 
+        a few dot products per step. The Jacobian is evaluated again after 
+        a step which reduces the residual norm by less than the factor 
+        jacobian_reuse_ratio, or at the same point if a step with a re-used 
+        Jacobian does not reduce it at all. Steps with a new Jacobian are 
+        damped as in newton_iterations."""
+        f = self.f
+        x0 = self._matrix(self.constraint(self.x0))
+        norm = self.norm
+        J = self.J
+        fx = self._matrix(f(list(x0)))
+        fxnorm = norm(fx)
+        solve = None
+        updates = [] #Broyden updates (step, correction) of the inverse
+        while True:
+            fresh = solve is None
+            if fresh:
+                try:
+                    solve = self.factorize(J(x0))
+                except ZeroDivisionError:
+                    break
+                updates = []
+            try:
+                s = self.apply_inverse(solve, updates, -fx)
+            except ZeroDivisionError:
+                break
+            l = self._mpfloat('1.0')
+            accepted = False
+            for damp_iter in range(self.max_damping):
+                x1 = x0 + l*s
+                if x1.tolist() == x0.tolist():
+                    break
+                x1 = self._matrix(self.constraint(x1))
+                fx1 = self._matrix(f(list(x1)))
+                newnorm = norm(fx1)
+                if newnorm <= fxnorm:
+                    accepted = True
+                if accepted or not fresh:
+                    break
+                l /= 2.0
+            if not accepted:
+                if fresh:
+                    if self.verbose > 1:
+                        print("Solver: Found stationary point.")
+                    break
+                solve = None #evaluate the Jacobian at x0
+                continue
+            if newnorm > self.jacobian_reuse_ratio*fxnorm:
+                solve = None
+            elif self.jacobian_update == 'broyden':
+                step = x1 - x0
+                Hy = self.apply_inverse(solve, updates, fx1 - fx)
+                denominator = self.dot(step,Hy)
+                if denominator != 0:
+                    updates.append((step,(step - Hy)*(1/denominator)))
+            x0, fx, fxnorm = x1, fx1, newnorm
+            yield (x0, fxnorm)
+
+    def factorize(self, Jx):
+        """Function solve(b) for Jx*s = b which re-uses a factorization of 
+        Jx: the float64 factorization of refined_solve for mixed precision, 
+        an LU decomposition for mpmath matrices and numpy arrays, and 
+        Axb_solver otherwise (e.g. sparse or non-square Jacobians). Raises 
+        ZeroDivisionError if Jx is singular."""
+        rows = getattr(Jx,'rows',None)
+        if rows is not None and rows == Jx.cols:
+            if self.mixed_precision and rows >= self.min_mixed_precision_size:
+                self._lu = None
+                return lambda b: self.refined_solve(Jx, b)
+            LU, p = mp.mp.LU_decomp(Jx.copy())
+            return lambda b: mp.mp.U_solve(LU, mp.mp.L_solve(LU, b, p))
+        elif (isinstance(Jx,np.ndarray) and Jx.ndim == 2 and 
+                Jx.shape[0] == Jx.shape[1]):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                lu = lu_factor(Jx)
+            if not np.all(np.isfinite(lu[0])) or 0 in np.diag(lu[0]):
+                raise ZeroDivisionError
+            return lambda b: lu_solve(lu, np.asarray(b).ravel())
+        return lambda b: self._Axb(Jx, b)
+
+    def apply_inverse(self, solve, updates, b):
+        """Solution of the factorized system solve(b) corrected by the 
+        Broyden updates [(step, correction),...] of the inverse Jacobian."""
+        x = solve(b)
+        for step, correction in updates:
+            x = x + correction*self.dot(step,x)
+        return x
+
+    def dogleg_iterations(self):
+        """Powell's dogleg trust-region method for minimizing |f|^2. The 
+        step is the Newton step if it is inside the trust region, and 
+        otherwise the point where the path from the steepest descent 
+        (Cauchy) step to the Newton step leaves the trust region. Steps 
+        are mapped through the constraint before they are evaluated, and 
+        the reduction of |f|^2 predicted by the linear model for the 
+        constrained step decides whether the step is accepted and how the 
+        trust region changes. The first trust region is the length of the 
+        first Newton step, so good initial guesses converge as with the 
+        plain Newton iteration. A singular Jacobian gives a steepest descent 
+        step rather than a cancellation."""
+        f = self.f
+        x0 = self._matrix(self.constraint(self.x0))
+        J = self.J
+        fx = self._matrix(f(list(x0)))
+        fxnorm = self.norm(fx)
+        fx2 = self.dot(fx,fx)
+        radius = None
+        while fx2 > 0:
+            Jx = J(x0)
+            try:
+                s_newton = self.newton_step(Jx, -fx)
+                newton_length = self.dot(s_newton,s_newton)**0.5
+            except ZeroDivisionError:
+                s_newton = None
+            g = self.matvec(Jx, fx, transpose=True) #gradient of |f|^2/2
+            g2 = self.dot(g,g)
+            Jg = self.matvec(Jx, g)
+            Jg2 = self.dot(Jg,Jg)
+            if s_newton is None and (g2 == 0 or Jg2 == 0):
+                break #stationary point of |f|^2
+            if radius is None:
+                if s_newton is not None:
+                    radius = newton_length
+                else:
+                    radius = g2/Jg2*g2**0.5
+            accepted = False
+            for attempt in range(self.max_damping):
+                s = self.dogleg_step(s_newton, g, g2, Jg2, radius)
+                x1 = self._matrix(self.constraint(x0 + s))
+                step = x1 - x0
+                step_length = self.dot(step,step)**0.5
+                if step_length == 0: #the constraint does not allow a step
+                    break
+                model = fx + self.matvec(Jx, step)
+                predicted = fx2 - self.dot(model,model)
+                fx1 = self._matrix(f(list(x1)))
+                fx12 = self.dot(fx1,fx1)
+                if predicted > 0:
+                    rho = (fx2 - fx12)/predicted
+                else:
+                    rho = -1
+                if rho < 0.25:
+                    radius = step_length/4
+                elif rho > 0.75 and step_length >= 0.99*radius:
+                    radius = 2*radius
+                if rho > self.min_trust_ratio:
+                    accepted = True
+                    break
+            if not accepted:
+                if self.verbose > 1:
+                    print("Solver: Trust region collapsed.")
+                break
+            x0, fx, fx2 = x1, fx1, fx12
+            fxnorm = self.norm(fx)
+            yield (x0, fxnorm)
+
+    def dogleg_step(self, s_newton, g, g2, Jg2, radius):
+        """Step of the dogleg method for the Newton step s_newton, the 
+        gradient g (with squared length g2 and squared length of J*g Jg2)
+        and the trust radius."""
+        if s_newton is not None:
+            if self.dot(s_newton,s_newton) <= radius**2:
+                return s_newton
+        g_length = g2**0.5
+        if s_newton is None or Jg2 == 0 or g2/Jg2*g_length >= radius:
+            return -(radius/g_length)*g
+        s_cauchy = -(g2/Jg2)*g
+        d = s_newton - s_cauchy
+        a = self.dot(d,d)
+        b = 2*self.dot(s_cauchy,d)
+        c = self.dot(s_cauchy,s_cauchy) - radius**2
+        tau = (-b + max(b**2 - 4*a*c,0)**0.5)/(2*a)
+        return s_cauchy + tau*d
+
+    def dot(self, u, v):
+        "Dot product of the vectors u and v."
+        return sum([ui*vi for ui,vi in zip(u,v)])
+
+    def matvec(self, A, x, transpose=False):
+        "Product of A (or its transpose) and the vector x."
+        if transpose:
+            A = A.T
+        if hasattr(A,'dot'): #numpy arrays and scipy sparse matrices
+            return A.dot(x)
+        return A*x
+
+    def float_factorization(self, A):
+        """LU factorization of A in float64. The rows and then the columns 
+        of A are scaled by their largest element before A is converted to 
+        float64, so that Jacobians with elements far outside of the float64 
+        range can be factorized."""
+        n = A.rows
+        A = [[A[i,j] for j in range(n)] for i in range(n)]
+        row_scale = []
+        for row in A:
+            m = max([abs(a) for a in row])
+            if m == 0:
+                raise ZeroDivisionError
+            row_scale.append(1/m)
+        A = [[a*d for a in row] for row,d in zip(A,row_scale)]
+        col_scale = []
+        for j in range(n):
+            m = max([abs(row[j]) for row in A])
+            if m == 0:
+                raise ZeroDivisionError
+            col_scale.append(1/m)
+        A = np.array([[float(a*d) for a,d in zip(row,col_scale)] 
+            for row in A])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            lu = lu_factor(A)
+        if not np.all(np.isfinite(lu[0])) or 0 in np.diag(lu[0]):
+            raise ZeroDivisionError
+        return lu, row_scale, col_scale
+
+    def refined_solve(self, A, b):
+        """Solve Ax=b at the precision of A and b using a float64 LU 
+        factorization of A followed by iterative refinement: the residual 
+        b-Ax is computed at full precision and the correction is solved 
+        with the float64 factorization. The factorization is re-used from 
+        the previous step as long as the refinement converges, and if it 
+        does not converge with a new factorization then A is solved 
+        directly with Axb_solver."""
+        bnorm = self.norm(b)
+        if bnorm == 0:
+            return b*0
+        for refactor in [self._lu is None, True]:
+            if refactor:
+                self._lu = self.float_factorization(A)
+            lu, row_scale, col_scale = self._lu
+            x = b*0
+            r = b
+            rnorm = bnorm
+            for i in range(self.max_refinements):
+                rs = np.array([float(ri*d) for ri,d in zip(r,row_scale)])
+                with np.errstate(all='ignore'):
+                    dx = lu_solve(lu,rs)
+                if not np.all(np.isfinite(dx)):
+                    break
+                x = x + self._matrix([self._mpfloat(dxi)*d 
+                    for dxi,d in zip(dx,col_scale)])
+                r = b - A*x
+                old_rnorm, rnorm = rnorm, self.norm(r)
+                if rnorm <= mp.eps*bnorm:
+                    return x
+                elif rnorm > old_rnorm/2:
+                    break
+            if refactor:
+                break
+        return self._Axb(A, b)
+
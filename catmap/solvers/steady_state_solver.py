@@ -1,12 +1,37 @@
 from solver_base import *
 from mean_field_solver import *
+from expression_optimizer import ExpressionOptimizer
 from catmap import string2symbols
 from scipy.optimize import fmin_powell as fmin
 from catmap.functions import numerical_jacobian
 import math
 from string import Template
 import random
-import re
+import os
+import hashlib
+import inspect
+import itertools
+import cPickle as pickle
+import scipy.sparse
+from scipy.sparse.linalg import splu
+
+def sparse_matrix(data,rows,cols,n):
+    "Square float64 sparse matrix with the elements data at rows,cols."
+    return scipy.sparse.csc_matrix(
+            (np.array(data,dtype=float),(rows,cols)),shape=(n,n))
+
+def sparse_Axb_solver(A,b):
+    "Solve Ax=b for the sparse matrix A using a sparse LU factorization."
+    try:
+        return splu(A).solve(np.array(b,dtype=float).ravel())
+    except RuntimeError: #singular matrix
+        raise ZeroDivisionError
+
+#source code of the modules generating the solver functions (by file name)
+_generator_source = {}
+
+#ids of the values of the parameters in memo keys (see get_parameter_version)
+_parameter_versions = itertools.count(1)
 
 class SteadyStateSolver(MeanFieldSolver):
 
@@ -18,14 +43,42 @@ class SteadyStateSolver(MeanFieldSolver):
                 residual_threshold = 0.9,
                 analytical_jacobian = True,
                 optimize_analytical_expressions = False,
+                float_presolve = False,
+                mixed_precision_newton = False,
+                trust_region_newton = False,
+                jacobian_update = None,
+                ode_fallback = False,
+                ode_max_steps = 200,
+                adaptive_precision = False,
+                min_decimal_precision = 30,
+                precision_guard_digits = 10,
+                sparse_jacobian = False,
+                kernel_loop_threshold = 100,
+                function_cache_dir = None,
+                memoization_capacity = 10000,
                 )
         self._rxm.update(defaults)
-        self._rate_constant_memoize = {}
-        self._steady_state_memoize = {}
+        self._rate_constant_memoize = MemoCache(self.memoization_capacity)
+        self._steady_state_memoize = MemoCache(self.memoization_capacity)
+        self._memo_parameters = {}
+        self._memo_versions = MemoCache(self.memoization_capacity)
+        self._precision_parameters = None
         self._required = {'max_rootfinding_iterations':int,
                           'internally_constrain_coverages':None,
                           'residual_threshold':float,
                           'analytical_jacobian':bool,
+                          'float_presolve':bool,
+                          'mixed_precision_newton':bool,
+                          'trust_region_newton':bool,
+                          'jacobian_update':None,
+                          'ode_fallback':bool,
+                          'ode_max_steps':int,
+                          'adaptive_precision':bool,
+                          'min_decimal_precision':int,
+                          'precision_guard_digits':int,
+                          'sparse_jacobian':bool,
+                          'kernel_loop_threshold':int,
+                          'memoization_capacity':int,
                           }
         self._log_strings = {'rootfinding_fail':
                             "stagnated or diverging (residual = ${resid})",
@@ -36,18 +89,36 @@ class SteadyStateSolver(MeanFieldSolver):
                             'rootfinding_success':
                             "found solution at point ${pt}",
                             'rootfinding_status':
-                            "converging (residual = ${resid})"}
+                            "converging (residual = ${resid})",
+                            'presolve_fail':
+                "could not polish float64 solution; solving from initial guess",
+                            'integration_success':
+                "reached steady state after ${n_steps} time steps",
+                            'integration_fail':
+        "no steady state after ${n_steps} time steps (residual = ${resid})",
+                            'precision_increase':
+                "increasing precision to ${precision} digits (residual = ${resid})",
+                            'functioncache_success':
+                            "loaded solver functions from ${cache_file}",
+                            'functioncache_fail':
+                            "could not save solver functions to ${cache_file}"}
     
     def get_rate_constants(self,rxn_parameters,coverages):
+        version = self.get_parameter_version('rate_constants',[rxn_parameters,
+            self._gas_energies,self._site_energies,[self.temperature]])
         if self.adsorbate_interaction_model not in [None,'ideal']:
-            memo = tuple(rxn_parameters) + tuple(coverages) + tuple(self._gas_energies)
+            memo = (version,tuple(coverages))
         else:
-            memo = tuple(rxn_parameters) + tuple(self._gas_energies)
-        if memo in self._rate_constant_memoize:
-            kf, kr = self._rate_constant_memoize[memo]
+            memo = version
+        memoized = self._rate_constant_memoize.get(memo)
+        if memoized is not None:
+            kf, kr = memoized
             self._kf = kf
             self._kr = kr
             return kf+kr
+        #the rate constants must not depend on the type of the parameters 
+        #(e.g. numpy floats from the scaler), since the memo does not
+        rxn_parameters = [self._mpfloat(p) for p in rxn_parameters]
         kfs, krs, dkfs, dkrs = self.rate_constants(rxn_parameters,coverages,
             self._gas_energies,self._site_energies,
             self.temperature,self.interaction_response_function,
@@ -57,6 +128,106 @@ class SteadyStateSolver(MeanFieldSolver):
         self._rate_constant_memoize[memo] = [kfs,krs]
         return kfs + krs
 
+    def get_rate_constant_temperature_derivatives(self,rxn_parameters,
+            coverages):
+        """Derivatives dln(k)/dT of the forward and reverse rate constants 
+        (kf+kr as from get_rate_constants) at fixed coverages. Since 
+        k = kB*T/h*exp(-G_a/(kB*T)), 
+        dln(k)/dT = 1/T + G_a/(kB*T^2) - (dG_a/dT)/(kB*T), where G_a is 
+        found from k. The free energies change by dG/dT = -S (from the 
+        thermodynamics), and since G_a is linear in the free energies the 
+        last term is given exactly by rate_constants with the free energies
+        shifted by -+h*S."""
+        T = self._mpfloat(self.temperature)
+        kB = self._kB
+        ln = self._math.log
+        dGdT, dGdT_gas, dGdT_site = \
+                self.get_free_energy_temperature_derivatives(rxn_parameters)
+        if self._mpfloat == float:
+            h = np.finfo(float).eps**(1./3)
+        else:
+            h = mp.cbrt(mp.eps)
+
+        def lnk(t):
+            shift = lambda Gs,dGs: [G+t*dG for G,dG in zip(Gs,dGs)]
+            kfs, krs, dEfs, dErs = self.rate_constants(
+                    shift(rxn_parameters,dGdT),coverages,
+                    shift(self._gas_energies,dGdT_gas),
+                    shift(self._site_energies,dGdT_site),
+                    T,self.interaction_response_function,
+                    self._mpfloat,self._matrix,self._math.exp)
+            return [ln(k) for k in kfs+krs]
+
+        prefactor = kB*T/self._h
+        k0 = self.get_rate_constants(rxn_parameters,coverages)
+        dlnk = []
+        for k,lnk_p,lnk_m in zip(k0,lnk(h),lnk(-h)):
+            G_a = -kB*T*ln(k/prefactor)
+            dlnk.append(1/T + G_a/(kB*T**2) + (lnk_p-lnk_m)/(2*h))
+        return dlnk
+
+    def get_free_energy_temperature_derivatives(self,rxn_parameters):
+        """Temperature derivatives dG/dT = -S of the free energies in 
+        rxn_parameters (0 for interaction parameters), the gas energies and 
+        the site energies."""
+        surface_species = self.adsorbate_names+self.transition_state_names
+        get_dGdT = self.thermodynamics.get_temperature_derivatives
+        dGdT = get_dGdT(surface_species)
+        dGdT += [0]*(len(rxn_parameters)-len(surface_species)) #interactions
+        dGdT_gas = get_dGdT(self.gas_names)
+        dGdT_site = get_dGdT(self.site_names)
+        return dGdT, dGdT_gas, dGdT_site
+
+    def get_temperature_shifted_turnover_frequency(self,rxn_parameters,dT):
+        """Turnover frequencies with the steady state solved again at the 
+        temperature T+dT, starting from the current coverages. The free 
+        energies are moved by dT*dG/dT, which is exact to first order in 
+        dT. The temperature, energies and coverages are restored 
+        afterwards."""
+        T = self.temperature
+        coverages = list(self._coverage)
+        gas_energies = self._gas_energies
+        site_energies = self._site_energies
+        dGdT, dGdT_gas, dGdT_site = \
+                self.get_free_energy_temperature_derivatives(rxn_parameters)
+        shift = lambda Gs,dGs: [G+dT*dG for G,dG in zip(Gs,dGs)]
+        try:
+            self.temperature = T+dT
+            self._gas_energies = shift(gas_energies,dGdT_gas)
+            self._site_energies = shift(site_energies,dGdT_site)
+            return self.get_turnover_frequency(shift(rxn_parameters,dGdT))
+        finally:
+            self.temperature = T
+            self._gas_energies = gas_energies
+            self._site_energies = site_energies
+            self._coverage = coverages
+            self.get_rate_constants(rxn_parameters,coverages)
+
+    def get_parameter_version(self,name,parameters):
+        """Id of the values of the list of parameters (lists of numbers) 
+        used in the keys of the memo called name. The parameters are 
+        compared to the parameters of the last call for name, which is 
+        cheap since they are usually the same objects, and only hashed when 
+        they have changed. The same values get the same id as long as they 
+        are among the last memoization_capacity values."""
+        parameters = [list(p) for p in parameters]
+        last = self._memo_parameters.get(name)
+        if last is not None and last[0] == parameters:
+            return last[1]
+        key = (name,tuple([tuple(p) for p in parameters]))
+        version = self._memo_versions.get(key)
+        if version is None:
+            version = _parameter_versions.next()
+            self._memo_versions[key] = version
+        self._memo_parameters[name] = [parameters,version]
+        return version
+
+    def get_memo_statistics(self):
+        """Dictionary of the hits, misses, size and capacity of the memos of
+        the rate constants and the steady-state function."""
+        return {'rate_constants':self._rate_constant_memoize.statistics(),
+                'steady_state':self._steady_state_memoize.statistics()}
+
     def get_coverage(self,rxn_parameters,c0=None,findrootArgs={}):
         if self.adsorbate_interaction_model in [None,'ideal'] or self.interaction_strength == 0:
             return self.get_ideal_coverages(rxn_parameters,c0,True,findrootArgs)
@@ -76,6 +247,259 @@ class SteadyStateSolver(MeanFieldSolver):
         self._coverage = [self._mpfloat(ci) for ci in c0]
         self._rxn_parameters = rxn_parameters
 
+        f_resid = lambda x: self.get_residual(x,True,False)
+        adaptive = (self.adaptive_precision == True and 
+                self._mpfloat != float)
+        if f_resid(c0) <= self.tolerance:
+            self._coverage = c0
+            if adaptive and self._precision_parameters != rxn_parameters:
+                self._working_precision = self.estimate_working_precision(
+                        c0,steady_state_fn)
+                self._precision_parameters = list(rxn_parameters)
+            return c0
+
+        #Converge in float64 first and polish the float solution at full 
+        #precision. Most points then only need one or two slow iterations.
+        c_float = None
+        if self.float_presolve == True and self._mpfloat != float:
+            c_float = self.get_float_steady_state_coverage(
+                    c0,steady_state_fn)
+
+        if adaptive:
+            coverages = self.get_adaptive_precision_coverage(
+                    c0,c_float,steady_state_fn,jacobian_fn)
+        else:
+            if self._mpfloat == float:
+                self._working_precision = self.decimal_precision
+            else:
+                self._working_precision = mp.mp.dps
+            coverages = self.solve_steady_state_coverage(
+                    c0,c_float,steady_state_fn,jacobian_fn)
+        self._precision_parameters = list(rxn_parameters)
+        return coverages
+
+    def solve_steady_state_coverage(self,c0,c_float,steady_state_fn,
+            jacobian_fn):
+        """Polish the float64 solution c_float (if not None) with 
+        find_steady_state_root, or solve from the coverages c0 if the 
+        polish fails. Coverages which are lost to round-off in float64 
+        (e.g. free sites on a nearly saturated surface) can keep the polish 
+        from converging."""
+        if c_float is not None:
+            try:
+                return self.find_steady_state_root(
+                        [self._mpfloat(ci) for ci in c_float],
+                        steady_state_fn,jacobian_fn)
+            except ValueError:
+                self.log('presolve_fail',priority=1)
+
+        return self.find_steady_state_root(c0,steady_state_fn,jacobian_fn)
+
+    def get_integrated_coverage(self,rxn_parameters,c0):
+        """Steady-state coverages found by integrating the coverages in time 
+        from c0 (see integrate_steady_state). This is much slower than 
+        get_coverage, and is used by the mapper (with ode_fallback) for 
+        points where Newton's method failed from all guesses. Raises 
+        ValueError if no steady state is found."""
+        if (self.adsorbate_interaction_model in [None,'ideal'] or 
+                self.interaction_strength == 0):
+            self.get_rate_constants(rxn_parameters,
+                    [0]*len(self.adsorbate_names))
+            steady_state_fn = self.ideal_steady_state_function
+            jacobian_fn = self.ideal_steady_state_jacobian
+        else:
+            steady_state_fn = self.interacting_steady_state_function
+            jacobian_fn = self.interacting_steady_state_jacobian
+        c0 = self.constrain_coverages(c0)
+        self.steady_state_function = steady_state_fn
+        self.steady_state_jacobian = jacobian_fn
+        self._coverage = [self._mpfloat(ci) for ci in c0]
+        self._rxn_parameters = rxn_parameters
+        coverages = self.integrate_steady_state(
+                c0,steady_state_fn,jacobian_fn)
+        if self._mpfloat == float:
+            self._working_precision = self.decimal_precision
+        else:
+            self._working_precision = mp.mp.dps
+        self._precision_parameters = list(rxn_parameters)
+        return coverages
+
+    def get_adaptive_precision_coverage(self,c0,c_float,steady_state_fn,
+            jacobian_fn):
+        """Solve for the steady-state coverages at the lowest working 
+        precision (mpmath dps) which reaches the tolerance. The solve 
+        starts at the precision from estimate_working_precision and the 
+        solution is accepted if its residual evaluated at the full 
+        precision of the model is below tolerance. Otherwise the precision 
+        is doubled (up to the full precision) and the solution is polished 
+        again. If the solve fails, the precision is only increased if the 
+        residual is within precision_guard_digits of the round-off in the 
+        residual (see get_residual_scale); otherwise more digits would not 
+        help and the ValueError is raised. The rate constants of 
+        interacting models are evaluated at the working precision. The 
+        precision used is saved in _working_precision."""
+        full_precision = mp.mp.dps
+        if c_float is not None:
+            x = c_float
+        else:
+            x = c0
+        precision = self.estimate_working_precision(x,steady_state_fn)
+        while precision < full_precision:
+            with mp.workdps(precision):
+                try:
+                    coverages = self.solve_steady_state_coverage(
+                            c0,c_float,steady_state_fn,jacobian_fn)
+                    error = None
+                except ValueError, error:
+                    coverages = self._coverage
+            resid = self.get_residual(coverages,True,False)
+            if error is None:
+                if resid <= self.tolerance:
+                    self._working_precision = precision
+                    return coverages
+                c_float = coverages
+            else:
+                scale = self.get_residual_scale(x,steady_state_fn)
+                if (scale is None or resid > 
+                        scale*10**(self.precision_guard_digits-precision)):
+                    self._working_precision = precision
+                    raise error
+            precision = min(2*precision,full_precision)
+            self.log('precision_increase',
+                    precision = precision,
+                    resid = float(resid),
+                    priority = 1)
+        self._working_precision = full_precision
+        return self.solve_steady_state_coverage(
+                c0,c_float,steady_state_fn,jacobian_fn)
+
+    def get_float_jacobian(self,coverages,steady_state_fn):
+        """Dense float64 array of the analytical jacobian of steady_state_fn 
+        at the coverages, or None if it is not available or not finite."""
+        functions = self.get_float_steady_state_functions(steady_state_fn)
+        if functions is None:
+            return None
+        f, J, Axb_solver = functions
+        x = [float(ci) for ci in coverages]
+        try:
+            with np.errstate(all='ignore'):
+                Jx = J(x)
+                if hasattr(Jx,'toarray'): #sparse
+                    Jx = Jx.toarray()
+                Jx = np.array(Jx,dtype=float)
+        except (OverflowError,ZeroDivisionError,ValueError):
+            return None
+        if not np.isfinite(Jx).all():
+            return None
+        return Jx
+
+    def get_residual_scale(self,coverages,steady_state_fn):
+        """Magnitude of the largest rate terms in the steady-state function 
+        close to the coverages, max_i sum_j |J_ij*theta_j| from the float64 
+        jacobian J (None if it is not available). The terms cancel at the 
+        steady state, so a residual evaluated with dps digits has a 
+        round-off error of about 10^-dps times the scale. The scale 
+        includes the cancellation in the free site coverages of nearly 
+        saturated surfaces."""
+        Jx = self.get_float_jacobian(coverages,steady_state_fn)
+        if Jx is None:
+            return None
+        x = np.array([float(ci) for ci in coverages])
+        return np.abs(Jx*x).sum(1).max()
+
+    def estimate_working_precision(self,coverages,steady_state_fn):
+        """Number of decimal digits needed to solve for the steady state 
+        close to the coverages. The round-off in the residual (see 
+        get_residual_scale) must be below tolerance, and Newton's method 
+        needs more digits than log10 of the condition number of the 
+        float64 jacobian. Adds precision_guard_digits and is clipped between 
+        min_decimal_precision and the full precision of the model, which 
+        is also returned if the estimate fails."""
+        full_precision = mp.mp.dps
+        Jx = self.get_float_jacobian(coverages,steady_state_fn)
+        if Jx is None:
+            return full_precision
+        x = np.array([float(ci) for ci in coverages])
+        scale = np.abs(Jx*x).sum(1).max()
+        try:
+            with np.errstate(all='ignore'):
+                condition = np.linalg.cond(Jx)
+            digits = max(math.log10(scale/float(self.tolerance)),
+                    math.log10(condition))
+        except (ValueError,np.linalg.linalg.LinAlgError):
+            return full_precision
+        if not np.isfinite(digits):
+            return full_precision
+        precision = int(math.ceil(digits)) + self.precision_guard_digits
+        return min(max(precision,self.min_decimal_precision),full_precision)
+
+    def integrate_steady_state(self,c0,steady_state_fn,jacobian_fn):
+        """Integrate the coverages in time from c0 with the linearly 
+        implicit Euler method until they are close to the steady state, and 
+        polish them with find_steady_state_root. The method is stable for 
+        stiff systems with any time step. The first time step changes the 
+        coverages by about 0.1 and the time step is then scaled by the 
+        decrease of the residual in each step (switched evolution 
+        relaxation) or reduced tenfold if the residual increases, so the 
+        steps become Newton steps close to the steady state. The polish is 
+        tried whenever the residual has decreased by three orders of 
+        magnitude since the last try. Raises ValueError if the steady state 
+        is not reached in ode_max_steps time steps."""
+        f = steady_state_fn
+        if self.analytical_jacobian == True:
+            J = jacobian_fn
+        else:
+            J = lambda x: numerical_jacobian(f,x,self._matrix)
+        if self.internally_constrain_coverages == True:
+            constraint = self.constrain_coverages
+        else:
+            constraint = lambda x: x
+        norm = self._math.infnorm
+
+        x = constraint(c0)
+        fx = self._matrix(f(x))
+        resid = norm(fx)
+        polish_resid = resid
+        dt = 0.1/max(resid,self.tolerance)
+        for step in range(self.ode_max_steps):
+            #(1/dt - J)*dx = f is one implicit Euler step for dtheta/dt = f
+            A = -J(x)
+            for i in range(len(x)):
+                A[i,i] += 1/dt
+            try:
+                dx = self._Axb_solver(A,fx)
+            except ZeroDivisionError:
+                dt /= 10
+                continue
+            x = constraint([xi+dxi for xi,dxi in zip(x,dx)])
+            fx = self._matrix(f(x))
+            old_resid, resid = resid, norm(fx)
+            if resid < old_resid:
+                dt *= min(old_resid/resid,10)
+            else: #e.g. steps which are undone by the constraint
+                dt /= 10
+            if resid <= 1e-3*polish_resid or step == self.ode_max_steps-1:
+                polish_resid = resid
+                try:
+                    coverages = self.find_steady_state_root(
+                            x,steady_state_fn,jacobian_fn)
+                    self.log('integration_success',
+                            n_steps = step+1,
+                            priority = 1)
+                    return coverages
+                except ValueError:
+                    pass
+
+        self.log('integration_fail',
+                n_steps = self.ode_max_steps,
+                resid = float(resid))
+        raise ValueError('No steady state after '+str(self.ode_max_steps)+\
+                ' time steps (resid='+str(float(resid))+')')
+
+    def find_steady_state_root(self,c0,steady_state_fn,jacobian_fn):
+        """Newton's method for the root of steady_state_fn starting from the 
+        coverages c0. Raises ValueError if the residual does not converge 
+        to tolerance."""
         #Enter root finding algorithm
         f = steady_state_fn
         f_resid = lambda x: self.get_residual(x,True,False)
@@ -87,18 +511,28 @@ class SteadyStateSolver(MeanFieldSolver):
             constraint = lambda x: x
         solver = NewtonRoot
 
-        if f_resid(c0) <= self.tolerance:
-            self._coverage = c0
-            return c0
-
         solver_kwargs = dict(
                 norm = norm,
                 verbose = self.verbose,
                 constraint = constraint,
+                mixed_precision = (self.mixed_precision_newton == True and 
+                    self._mpfloat != float),
+                trust_region = (self.trust_region_newton == True),
+                jacobian_update = self.jacobian_update,
                 )
 
+        Axb_solver = self._Axb_solver
         if self.analytical_jacobian == True:
             solver_kwargs['J'] = jacobian_fn
+            sparse_jacobians = {
+                    self.ideal_steady_state_jacobian:
+                    self.ideal_steady_state_sparse_jacobian,
+                    self.interacting_steady_state_jacobian:
+                    self.interacting_steady_state_sparse_jacobian}
+            if (self.sparse_jacobian == True and self._mpfloat == float and
+                    jacobian_fn in sparse_jacobians):
+                solver_kwargs['J'] = sparse_jacobians[jacobian_fn]
+                Axb_solver = sparse_Axb_solver
         else:
             def J(x):
                 return numerical_jacobian(f,x,self._matrix)
@@ -106,7 +540,7 @@ class SteadyStateSolver(MeanFieldSolver):
 
 
         iterations = solver(f,c0, self._matrix, self._mpfloat, 
-                            self._Axb_solver, **solver_kwargs)
+                            Axb_solver, **solver_kwargs)
         old_error = 1e99
         coverages = None
         maxiter = self.max_rootfinding_iterations
@@ -149,10 +583,7 @@ class SteadyStateSolver(MeanFieldSolver):
             self._coverage = x
             self._error = error
 
-        if coverages:
-            self._coverage = [c for c in coverages]
-            return [c for c in coverages]
-        else:
+        if not coverages:
             if f_resid(x) < self.tolerance:
                 coverages = self.constrain_coverages(x)
             else:
@@ -161,6 +592,224 @@ class SteadyStateSolver(MeanFieldSolver):
                         resid=float(f_resid(x)))
                 raise ValueError('Solver cancellation. (resid='+\
                         str(float(f_resid(x)))+')')
+        self._coverage = [c for c in coverages]
+        return [c for c in coverages]
+
+    def get_float_steady_state_coverage(self,c0,steady_state_fn):
+        """Run Newton's method for the root of steady_state_fn in float64 
+        from the coverages c0, using the current rate constants or reaction 
+        parameters. Iterates until the residual stops decreasing (usually at 
+        the limit of float64) and returns the coverages with the lowest 
+        residual, or None if the residual was not reduced."""
+        functions = self.get_float_steady_state_functions(steady_state_fn)
+        if functions is None:
+            return None
+        f, J, Axb_solver = functions
+
+        c_min = float(self._mpfloat(10)**(-self.decimal_precision))
+        if self.internally_constrain_coverages == True:
+            constraint = lambda x: self.constrain_coverage_function(
+                    list(x),float,c_min)
+        else:
+            constraint = lambda x: x
+
+        norm = lambda x: np.linalg.norm(x,np.inf)
+        iterations = NewtonRoot(f,[float(ci) for ci in c0],np.array,float,
+                Axb_solver,J=J,norm=norm,verbose=self.verbose,
+                constraint=constraint,jacobian_update=self.jacobian_update)
+        tolerance = float(self.tolerance)
+        best = None
+        try:
+            with np.errstate(all='ignore'):
+                x0 = constraint([float(ci) for ci in c0])
+                best_error = old_error = norm(f(x0))
+                for i,(x,error) in enumerate(iterations):
+                    if not error < best_error:
+                        break
+                    best, best_error = list(x), error
+                    if (error < tolerance or 
+                            error >= self.residual_threshold*old_error or
+                            i+1 >= self.max_rootfinding_iterations):
+                        break
+                    old_error = error
+        except (OverflowError,ZeroDivisionError,ValueError):
+            pass
+        return best
+
+    def get_float_steady_state_functions(self,steady_state_fn):
+        """float64 versions f(x), J(x) of steady_state_fn and its analytical 
+        jacobian for the current rate constants or reaction parameters, 
+        and a solver for J(x)*dx = b. None if there is no analytical 
+        jacobian or steady_state_fn is not one of the mean field functions."""
+        p = [float(pi) for pi in self.gas_pressures]
+        if self.sparse_jacobian == True:
+            ideal_jacobian = self.ideal_mean_field_sparse_jacobian
+            interacting_jacobian = self.interacting_mean_field_sparse_jacobian
+            J_matrix = sparse_matrix
+            Axb_solver = sparse_Axb_solver
+        else:
+            ideal_jacobian = self.ideal_mean_field_jacobian
+            interacting_jacobian = self.interacting_mean_field_jacobian
+            J_matrix = np.array
+            def Axb_solver(A,b):
+                try:
+                    return np.linalg.solve(A,b)
+                except np.linalg.linalg.LinAlgError:
+                    raise ZeroDivisionError
+
+        if self.analytical_jacobian != True:
+            return None
+
+        if steady_state_fn == self.ideal_steady_state_function:
+            kf = [float(k) for k in self._kf]
+            kr = [float(k) for k in self._kr]
+            def f(x):
+                return self.ideal_mean_field_steady_state(
+                        kf,kr,x,p,float,np.array)
+            def J(x):
+                return ideal_jacobian(kf,kr,x,p,float,J_matrix)
+        elif steady_state_fn == self.interacting_steady_state_function:
+            rxn_parameters = [float(pi) for pi in self._rxn_parameters]
+            args = [p,[float(E) for E in self._gas_energies],
+                    [float(E) for E in self._site_energies],
+                    float(self.temperature),self.interaction_response_function,
+                    float]
+            def f(x):
+                return self.interacting_mean_field_steady_state(
+                        rxn_parameters,x,*(args+[np.array,math.exp]))
+            def J(x):
+                return interacting_jacobian(
+                        rxn_parameters,x,*(args+[J_matrix,math.exp]))
+        else:
+            return None
+        return f, J, Axb_solver
+
+    def get_batch_coverages(self,rxn_parameter_list,c0_list):
+        """Steady-state coverages for each of the reaction parameters in 
+        rxn_parameter_list, starting from the corresponding coverages in 
+        c0_list. For ideal models Newton's method is first run on all points 
+        at once in float64 (see get_float_batch_coverages) and each point 
+        is then polished at full precision. Returns a list with the 
+        coverages at each point, or None where no solution was found."""
+        if (self.adsorbate_interaction_model in [None,'ideal'] or 
+                self.interaction_strength == 0):
+            c_float = self.get_float_batch_coverages(
+                    rxn_parameter_list,c0_list)
+        else: #rate constants depend on coverages and are not vectorized
+            c_float = [None]*len(c0_list)
+
+        coverage_list = []
+        for rxn_parameters,c0,cf in zip(rxn_parameter_list,c0_list,c_float):
+            if cf is not None:
+                c0 = [self._mpfloat(ci) for ci in cf]
+            try:
+                coverage_list.append(self.get_coverage(rxn_parameters,c0))
+            except ValueError:
+                coverage_list.append(None)
+        return coverage_list
+
+    def get_float_batch_coverages(self,rxn_parameter_list,c0_list):
+        """Run Newton's method in float64 for the ideal steady state of 
+        all points in rxn_parameter_list at once. The compiled steady-state 
+        and jacobian functions only use element-wise arithmetic, so they are 
+        evaluated for all points by passing an array over the points for 
+        each rate constant and coverage. The steps are solved with stacked 
+        calls to np.linalg.solve and each point is damped and stopped 
+        (converged, stagnated or stationary) on its own. Returns a list with 
+        the coverages with the lowest residual at each point, or None where 
+        the residual was not reduced."""
+        n_points = len(c0_list)
+        if not n_points:
+            return []
+        kf = []
+        kr = []
+        for rxn_parameters in rxn_parameter_list:
+            self.get_rate_constants(rxn_parameters,
+                    [0]*len(self.adsorbate_names))
+            kf.append([float(k) for k in self._kf])
+            kr.append([float(k) for k in self._kr])
+        kf = np.array(kf)
+        kr = np.array(kr)
+        p = [float(pi) for pi in self.gas_pressures]
+        identity = lambda x: x
+
+        def f(x,idx):
+            dtheta_dt = self.ideal_mean_field_steady_state(list(kf[idx].T),
+                    list(kr[idx].T),list(x.T),p,float,identity)
+            return np.array([np.zeros(len(idx))+fi for fi in dtheta_dt]).T
+
+        def J(x,idx):
+            Jx = self.ideal_mean_field_jacobian(list(kf[idx].T),
+                    list(kr[idx].T),list(x.T),p,float,identity)
+            Jx = np.array([[np.zeros(len(idx))+Jij for Jij in row] 
+                for row in Jx])
+            return Jx.transpose(2,0,1)
+
+        c_min = float(self._mpfloat(10)**(-self.decimal_precision))
+        def constraint(x):
+            if self.internally_constrain_coverages != True:
+                return x
+            return np.array([self.constrain_coverage_function(
+                list(xi),float,c_min) for xi in x])
+
+        def norm(fx):
+            resid = abs(fx).max(axis=1)
+            resid[~np.isfinite(resid)] = np.inf
+            return resid
+
+        def solve(A,b):
+            try:
+                return np.linalg.solve(A,b)
+            except np.linalg.linalg.LinAlgError: #solve points one by one
+                s = np.zeros(b.shape)+np.nan
+                for i in range(len(b)):
+                    try:
+                        s[i] = np.linalg.solve(A[i],b[i])
+                    except np.linalg.linalg.LinAlgError:
+                        pass
+                return s
+
+        tolerance = float(self.tolerance)
+        max_damping = 10
+        all_points = np.arange(n_points)
+        with np.errstate(all='ignore'):
+            x = constraint(np.array([[float(ci) for ci in c0] 
+                for c0 in c0_list]))
+            fx = f(x,all_points)
+            error = norm(fx)
+            initial_error = error.copy()
+            active = np.isfinite(error) & (error >= tolerance)
+            for i in range(self.max_rootfinding_iterations):
+                idx = all_points[active]
+                if not len(idx):
+                    break
+                old_error = error[idx]
+                s = solve(J(x[idx],idx),-fx[idx])
+                step = np.ones(len(idx))
+                accepted = np.zeros(len(idx),dtype=bool)
+                trying = np.all(np.isfinite(s),axis=1)
+                for damp_iter in range(max_damping):
+                    if not np.any(trying):
+                        break
+                    t = np.where(trying)[0]
+                    x1 = constraint(x[idx[t]] + step[t,None]*s[t])
+                    fx1 = f(x1,idx[t])
+                    error1 = norm(fx1)
+                    moved = np.any(x1 != x[idx[t]],axis=1)
+                    ok = (error1 <= error[idx[t]]) & moved
+                    x[idx[t[ok]]] = x1[ok]
+                    fx[idx[t[ok]]] = fx1[ok]
+                    error[idx[t[ok]]] = error1[ok]
+                    accepted[t[ok]] = True
+                    trying[t[ok]] = False
+                    trying[t[~moved]] = False #stationary point
+                    step[t] /= 2
+                #stop points which are converged, stationary or stagnated
+                active[idx] = (accepted & (error[idx] >= tolerance) & 
+                        (error[idx] < self.residual_threshold*old_error))
+
+        return [list(xi) if ei < e0 else None 
+                for xi,ei,e0 in zip(x,error,initial_error)]
 
     def get_ideal_coverages(self,rxn_parameters,c0=None,
             refresh_rate_constants=True,findrootArgs={}):
@@ -254,29 +903,33 @@ class SteadyStateSolver(MeanFieldSolver):
 
 
     def interacting_steady_state_function(self,coverages):
-        memo = tuple(self._rxn_parameters) + tuple(self._gas_energies) + \
-                tuple(self._site_energies) + tuple(coverages) + tuple(self.gas_pressures+[self.temperature])
-        if memo in self._steady_state_memoize:
-            return self._steady_state_memoize[memo]
-        else:
+        version = self.get_parameter_version('steady_state',[
+            self._rxn_parameters,self._gas_energies,self._site_energies,
+            self.gas_pressures,[self.temperature]])
+        #keyed by precision (see get_adaptive_precision_coverage)
+        memo = (version,mp.mp.dps,tuple(coverages))
+        c = self._steady_state_memoize.get(memo)
+        if c is None:
             c = self.interacting_mean_field_steady_state(
                     self._rxn_parameters,coverages,self.gas_pressures,
                     self._gas_energies, self._site_energies,
                     self.temperature,self.interaction_response_function,
                     self._mpfloat, self._matrix,self._math.exp)
             self._steady_state_memoize[memo] = c
-            return c
+        return c
 
     def ideal_steady_state_function(self,coverages):
-        memo = tuple(self._kf) + tuple(self._kr) + tuple(coverages) + tuple(self.gas_pressures+[self.temperature])
-        if memo in self._steady_state_memoize:
-            return self._steady_state_memoize[memo]
-        else:
+        version = self.get_parameter_version('steady_state',[
+            self._kf,self._kr,self.gas_pressures,[self.temperature]])
+        #keyed by precision (see get_adaptive_precision_coverage)
+        memo = (version,mp.mp.dps,tuple(coverages))
+        c = self._steady_state_memoize.get(memo)
+        if c is None:
             c = self.ideal_mean_field_steady_state(
                     self._kf,self._kr,coverages,self.gas_pressures,
                     self._mpfloat, self._matrix)
             self._steady_state_memoize[memo] = c
-            return c
+        return c
 
     def interacting_steady_state_jacobian(self,coverages):
         J = self.interacting_mean_field_jacobian(
@@ -292,185 +945,464 @@ class SteadyStateSolver(MeanFieldSolver):
                 self._mpfloat, self._matrix)
         return J
 
+    def interacting_steady_state_sparse_jacobian(self,coverages):
+        J = self.interacting_mean_field_sparse_jacobian(
+                self._rxn_parameters,coverages,self.gas_pressures,
+                self._gas_energies,self._site_energies,
+                self.temperature,self.interaction_response_function,
+                self._mpfloat, sparse_matrix,self._math.exp)
+        return J
+
+    def ideal_steady_state_sparse_jacobian(self,coverages):
+        J = self.ideal_mean_field_sparse_jacobian(
+                self._kf,self._kr,coverages,self.gas_pressures,
+                self._mpfloat, sparse_matrix)
+        return J
+
+    def get_float_parameters(self,rxn_parameters):
+        """float64 copies of the parameters of the steady-state function 
+        for the reaction parameters rxn_parameters (at the current point),
+        as used by get_approximate_residuals."""
+        float_parameters = dict(
+                p = [float(pi) for pi in self.gas_pressures],
+                c_min = float(self._mpfloat(10)**(-self.decimal_precision)),
+                )
+        if (self.adsorbate_interaction_model in [None,'ideal'] or 
+                self.interaction_strength == 0):
+            self.get_rate_constants(rxn_parameters,
+                    [0]*len(self.adsorbate_names))
+            float_parameters['kf'] = [float(k) for k in self._kf]
+            float_parameters['kr'] = [float(k) for k in self._kr]
+        else:
+            float_parameters['rxn_parameters'] = [
+                    float(pi) for pi in rxn_parameters]
+            float_parameters['gas_energies'] = [
+                    float(E) for E in self._gas_energies]
+            float_parameters['site_energies'] = [
+                    float(E) for E in self._site_energies]
+            float_parameters['T'] = float(self.temperature)
+            float_parameters['F'] = self.interaction_response_function
+        return float_parameters
+
+    def get_approximate_residuals(self,coverage_list,float_parameters):
+        """Residuals of each coverage vector in coverage_list, evaluated in 
+        float64 with the parameters from get_float_parameters. Cheap enough 
+        to rank many guesses at once: for ideal models all guesses are 
+        evaluated in a single vectorized call of the compiled steady-state 
+        function. Residuals which can not be represented in float64 are 
+        returned as inf."""
+        n_guesses = len(coverage_list)
+        fp = float_parameters
+        constrain = self.constrain_coverage_function
+        coverage_list = [constrain([float(ci) for ci in cvg],float,fp['c_min'])
+                for cvg in coverage_list]
+        identity = lambda x: x
+
+        if 'kf' in fp:
+            theta = list(np.array(coverage_list,dtype=float).T)
+            with np.errstate(all='ignore'):
+                dtheta_dt = self.ideal_mean_field_steady_state(
+                        fp['kf'],fp['kr'],theta,fp['p'],float,identity)
+                dtheta_dt = np.array([np.zeros(n_guesses)+fi 
+                    for fi in dtheta_dt])
+                resid = abs(dtheta_dt).max(axis=0)
+        else:
+            steady_state_fn = self.interacting_mean_field_steady_state
+            resid = np.zeros(n_guesses)
+            for i,cvg in enumerate(coverage_list):
+                try:
+                    dtheta_dt = steady_state_fn(fp['rxn_parameters'],cvg,
+                            fp['p'],fp['gas_energies'],fp['site_energies'],
+                            fp['T'],fp['F'],float,identity,math.exp)
+                    resid[i] = max([abs(fi) for fi in dtheta_dt])
+                except (OverflowError,ZeroDivisionError,ValueError):
+                    resid[i] = np.inf
+        resid[~np.isfinite(resid)] = np.inf
+        return resid
+
+    def get_coverage_derivative(self,coverages,descriptors,direction,h=1e-5):
+        """Derivative of the steady-state coverages with respect to t at 
+        the point descriptors + t*direction in descriptor space (t=0), 
+        from dtheta/dt = -J^-1 df/dt. df/dt is the change in the 
+        steady-state function at fixed coverages, and is found by central 
+        differences of the reaction parameters."""
+        if (self.adsorbate_interaction_model in [None,'ideal'] or 
+                self.interaction_strength == 0):
+            steady_state_fn = self.ideal_steady_state_function
+            jacobian_fn = self.ideal_steady_state_jacobian
+        else:
+            steady_state_fn = self.interacting_steady_state_function
+            jacobian_fn = self.interacting_steady_state_jacobian
+
+        def f(t):
+            self._descriptors = [d+t*v for d,v in zip(descriptors,direction)]
+            self._rxn_parameters = self.scaler.get_rxn_parameters(
+                    self._descriptors)
+            self.get_rate_constants(self._rxn_parameters,coverages)
+            return self._matrix(steady_state_fn(coverages))
+
+        dfdt = (f(h) - f(-h))/(2*h)
+        f(0)
+        if self.analytical_jacobian == True:
+            J = jacobian_fn(coverages)
+        else:
+            J = numerical_jacobian(steady_state_fn,coverages,self._matrix)
+        return self._Axb_solver(J,-dfdt)
+
+    def get_coverage_sensitivity(self,rxn_parameters,coverages,h=1e-14):
+        """Derivatives dtheta_i/dG_j of the steady-state coverages with 
+        respect to the reaction parameters, from the implicit function 
+        theorem dtheta/dG = -J^-1 df/dG. df/dG is the change in the 
+        steady-state function at fixed coverages and is found by finite 
+        differences, so no steady state is solved again. Raises 
+        ZeroDivisionError if J is singular or the coverages are not a 
+        steady state (see solve_sensitivity_equations)."""
+        if (self.adsorbate_interaction_model in [None,'ideal'] or 
+                self.interaction_strength == 0):
+            steady_state_fn = self.ideal_steady_state_function
+            refresh_rate_constants = True
+        else:
+            steady_state_fn = self.interacting_steady_state_function
+            #the rate constants are computed by steady_state_fn
+            refresh_rate_constants = False
+
+        def f(G):
+            self._rxn_parameters = list(G)
+            if refresh_rate_constants:
+                self.get_rate_constants(self._rxn_parameters,coverages)
+            return self._matrix(steady_state_fn(coverages))
+
+        dfdG = numerical_jacobian(f,rxn_parameters,self._matrix,h,
+                central=True)
+        self._rxn_parameters = list(rxn_parameters)
+        self.get_rate_constants(self._rxn_parameters,coverages)
+        return self.solve_sensitivity_equations(coverages,
+                [[dfdG[i,j] for j in range(len(rxn_parameters))]
+                    for i in range(len(coverages))])
+
+    def solve_sensitivity_equations(self,coverages,dfdx):
+        """Derivatives dtheta/dx = -J^-1 df/dx of the steady-state 
+        coverages with respect to some parameters x, given the derivatives 
+        dfdx (list of rows) of the steady-state function at fixed coverages.
+        J is the Jacobian of the steady-state function at coverages and all 
+        columns are solved with one LU factorization of J. Coverages which 
+        are held at the lower bound of constrain_coverages do not change, 
+        and are left out of the equations. The derivatives only hold at a 
+        root of the steady-state function, so the Newton step J^-1 f must 
+        be negligible compared to the other coverages (it is not when e.g. 
+        the coverages are held at the site total). Raises 
+        ZeroDivisionError if J is singular or the Newton step is not 
+        negligible."""
+        if (self.adsorbate_interaction_model in [None,'ideal'] or 
+                self.interaction_strength == 0):
+            steady_state_fn = self.ideal_steady_state_function
+            jacobian_fn = self.ideal_steady_state_jacobian
+        else:
+            steady_state_fn = self.interacting_steady_state_function
+            jacobian_fn = self.interacting_steady_state_jacobian
+        if self.analytical_jacobian == True:
+            J = jacobian_fn(coverages)
+        else:
+            J = numerical_jacobian(steady_state_fn,coverages,self._matrix)
+        f = steady_state_fn(coverages)
+
+        n_cvg = len(coverages)
+        n_x = len(dfdx[0]) if dfdx else 0
+        min_cvg = self._mpfloat(10**(-(self.decimal_precision)))
+        free = [i for i in range(n_cvg) if coverages[i] > min_cvg]
+        dcdx = [[0]*n_x for i in range(n_cvg)]
+        if not free:
+            return dcdx
+        #the first column is the Newton step
+        if self._mpfloat == float:
+            J = np.array(J,dtype=float)[np.ix_(free,free)]
+            f = np.array(f,dtype=float).ravel()
+            b = np.array([[f[i]]+[-dfdx[i][j] for j in range(n_x)] 
+                for i in free],dtype=float)
+            try:
+                x = np.linalg.solve(J,b).tolist()
+            except np.linalg.linalg.LinAlgError:
+                raise ZeroDivisionError('Singular steady-state Jacobian')
+        else:
+            J = self._matrix([[J[i,j] for j in free] for i in free])
+            LU, p = mp.mp.LU_decomp(J)
+            x = [[0]*(n_x+1) for i in free]
+            for j in range(n_x+1):
+                if j == 0:
+                    b = self._matrix([f[i] for i in free])
+                else:
+                    b = self._matrix([-dfdx[i][j-1] for i in free])
+                xj = mp.mp.U_solve(LU,mp.mp.L_solve(LU,b,p))
+                for k in range(len(free)):
+                    x[k][j] = xj[k]
+
+        tol = np.finfo(float).eps**0.5
+        for k,i in enumerate(free):
+            if not abs(x[k][0]) <= tol*coverages[i]:
+                raise ZeroDivisionError('Coverages are not a steady state'+\
+                        ' (Newton step = '+str(float(x[k][0]))+')')
+            dcdx[i] = x[k][1:]
+        return dcdx
+
     def constrain_coverages(self,cvgs):
         min_cvg = self._mpfloat(10**(-(self.decimal_precision)))
         cvgs = self.constrain_coverage_function(list(cvgs),self._mpfloat,min_cvg)
         return cvgs
 
     def compile(self):
+        for memo in [self._rate_constant_memoize,self._steady_state_memoize,
+                self._memo_versions]:
+            memo.capacity = self.memoization_capacity
         if not self._compiled:
-            intermediate_subs = {}
-            self._function_substitutions.update(
-                    self.substitutions_dict())
+            cache_file = self.get_function_cache_file()
+            if not self.load_function_cache(cache_file):
+                self.generate_functions()
+                self.save_function_cache(cache_file)
+
+            self._compiled = True
+
+            if self.adsorbate_interaction_model not in [None,'ideal']:
+                self.steady_state_function = self.interacting_steady_state_function
+            else:
+                self.steady_state_function = self.ideal_steady_state_function
+
+    def get_function_cache_file(self):
+        """Path of the file in function_cache_dir for the functions 
+        generated for this reaction network and these settings, or None if 
+        function_cache_dir is not set. The file name is a hash of everything 
+        the generated functions depend on (including the templates and the 
+        code generating the expressions), but not of the energies or 
+        conditions, which are arguments of the functions."""
+        if not self.function_cache_dir:
+            return None
+        template_text = ''.join([templates[k] for k in sorted(templates)])
+        substitutions = [[k,v] for k,v in 
+                sorted(self.substitutions_dict().items())
+                if '${'+k+'}' in template_text] #e.g. not the temperature
+        key = repr([substitutions, template_text,
+            self.elementary_rxns, self.adsorbate_names, 
+            self.transition_state_names, self.gas_names, self.site_names,
+            self.adsorbate_interaction_model, self.numerical_representation,
+            self.optimize_analytical_expressions,
+            self.sparse_jacobian == True,
+            len(self.elementary_rxns) >= self.kernel_loop_threshold,
+            self.get_generator_source()])
+        return os.path.join(self.function_cache_dir,
+                hashlib.sha1(key).hexdigest()+'.pkl')
+
+    def get_generator_source(self):
+        "Source code of the modules which generate the function strings."
+        source = ''
+        for cls in [MeanFieldSolver,SteadyStateSolver,ExpressionOptimizer]:
+            filename = inspect.getsourcefile(cls)
+            if filename not in _generator_source:
+                f = open(filename)
+                _generator_source[filename] = f.read()
+                f.close()
+            source += _generator_source[filename]
+        return source
+
+    def load_function_cache(self,cache_file):
+        """Compile the function strings saved in cache_file. Returns False 
+        if there is no cache file or it can not be read."""
+        if not cache_file or not os.path.exists(cache_file):
+            return False
+        try:
+            f = open(cache_file,'rb')
+            function_strings = pickle.load(f)
+            f.close()
+        except Exception:
+            return False
+        for func_name,func_string in function_strings.items():
+            locs = {}
+            exec func_string in globals(), locs
+            setattr(self,func_name,locs[func_name])
+        self._function_strings = function_strings
+        self.log('functioncache_success',
+                cache_file = cache_file,
+                pt = 'solver',
+                priority = 1)
+        return True
+
+    def save_function_cache(self,cache_file):
+        """Save the generated function strings to cache_file. The file is 
+        written under another name and then renamed, so that jobs sharing 
+        function_cache_dir never read a partially written file."""
+        if not cache_file:
+            return
+        function_strings = dict([(func,self._function_strings[func]) 
+            for func in self._function_templates])
+        tmp_file = cache_file+'.'+str(os.getpid())
+        if not os.path.isdir(self.function_cache_dir):
+            try:
+                os.makedirs(self.function_cache_dir)
+            except OSError: #e.g. made by another job in the meantime
+                pass
+        try:
+            f = open(tmp_file,'wb')
+            pickle.dump(function_strings,f,-1)
+            f.close()
+            os.rename(tmp_file,cache_file)
+        except (IOError,OSError):
+            self.log('functioncache_fail',
+                    cache_file = cache_file,
+                    pt = 'solver')
+
+    def generate_functions(self):
+        "Generate the static functions of the solver from the templates."
+        #work on a copy of the templates so that the module templates are 
+        #not changed by the substitutions for this model
+        function_templates = dict(templates)
+        self._function_substitutions.update(
+                self.substitutions_dict())
+
+        #make 2 versions of rate-constants function
+        energy_expressions_noderivs = '\n    '.join(self.reaction_energy_equations(adsorbate_interactions = False))
+        energy_expressions_derivs = '\n    '.join(self.reaction_energy_equations(adsorbate_interactions = True))
 
-            #make 2 versions of rate-constants function
-            energy_expressions_noderivs = '\n    '.join(self.reaction_energy_equations(adsorbate_interactions = False))
-            energy_expressions_derivs = '\n    '.join(self.reaction_energy_equations(adsorbate_interactions = True))
+        function_templates['rate_constants_no_derivatives'] = Template(function_templates['rate_constants']).safe_substitute({'elementary_step_energetics':energy_expressions_noderivs})
+        function_templates['rate_constants_with_derivatives'] = Template(function_templates['rate_constants']).safe_substitute({'elementary_step_energetics':energy_expressions_derivs})
 
-            templates['rate_constants_no_derivatives'] = Template(templates['rate_constants']).safe_substitute({'elementary_step_energetics':energy_expressions_noderivs})
-            templates['rate_constants_with_derivatives'] = Template(templates['rate_constants']).safe_substitute({'elementary_step_energetics':energy_expressions_derivs})
+        #large networks use loops over stoichiometry tables rather 
+        #than unrolled expressions for each step
+        use_loops = (len(self.elementary_rxns) >= 
+                self.kernel_loop_threshold)
 
-            #make steady-state expressions
+        #make steady-state expressions
+        if use_loops:
+            ss_eqs = self.loop_rate_equations()
+        else:
             ss_eqs = self.rate_equations()
-            self._function_substitutions['steady_state_expressions'] = '\n    '.join(ss_eqs)
-            
-            #make jacobian expressions
-            jac_eqs = self.jacobian_equations(adsorbate_interactions=True)
-            self._function_substitutions['jacobian_expressions'] = '\n    '.join(jac_eqs)
-            jac_eqs_nd = self.jacobian_equations(adsorbate_interactions=False)
-            self._function_substitutions['jacobian_expressions_no_derivatives'] = '\n    '.join(jac_eqs_nd)
-
-            def indent_string(string,levels):
-                lines = string.split('\n')
-                indention = '\n'+'    '*levels
-                return indention.join(lines)
-            
-            #pre-substitute the interaction function into rate_constants (needed because its nested 2 levels)
-            indented = indent_string(templates[self.adsorbate_interaction_model+'_interaction_function'],1)
-            indented = Template(indented).substitute(self._function_substitutions)
-            self._function_substitutions['interaction_function'] = indented
-
-            for f in ['rate_constants_no_derivatives','rate_constants_with_derivatives']:
-                templates[f] = Template(templates[f]).substitute(self._function_substitutions)
-
-            #indent rate_constant functions because they are nested 1 level
-            indented_funcs = [
-                    ['rate_constants_no_derivatives',''],
-                    ['rate_constants_with_derivatives',''],
-                    ]
+        expressions = {'steady_state_expressions':ss_eqs}
+        
+        #make jacobian expressions (and sparse jacobian expressions, which 
+        #are only used with sparse_jacobian)
+        variants = [[False,'']]
+        if self.sparse_jacobian == True:
+            variants.append([True,'sparse_'])
+        for sparse,prefix in variants:
+            for derivs,suffix in [[True,''],[False,'_no_derivatives']]:
+                if use_loops:
+                    jac_eqs = self.loop_jacobian_equations(
+                            adsorbate_interactions=derivs,sparse=sparse)
+                elif sparse:
+                    jac_eqs = self.sparse_jacobian_equations(
+                            adsorbate_interactions=derivs)
+                else:
+                    jac_eqs = self.jacobian_equations(
+                            adsorbate_interactions=derivs)
+                expressions[prefix+'jacobian_expressions'+suffix] = jac_eqs
+
+        for key in expressions:
+            self._function_substitutions[key] = '\n    '.join(expressions[key])
+
+        optimize = (self.optimize_analytical_expressions and not use_loops)
+        if optimize:
+            for key in expressions:
+                optimized = ExpressionOptimizer().optimize(expressions[key])
+                self._function_substitutions[key] = '\n    '.join(optimized)
+
+        def indent_string(string,levels):
+            lines = string.split('\n')
+            indention = '\n'+'    '*levels
+            return indention.join(lines)
+        
+        #pre-substitute the interaction function into rate_constants (needed because its nested 2 levels)
+        indented = indent_string(function_templates[self.adsorbate_interaction_model+'_interaction_function'],1)
+        indented = Template(indented).substitute(self._function_substitutions)
+        self._function_substitutions['interaction_function'] = indented
+
+        for f in ['rate_constants_no_derivatives','rate_constants_with_derivatives']:
+            function_templates[f] = Template(function_templates[f]).substitute(self._function_substitutions)
+
+        #indent rate_constant functions because they are nested 1 level
+        indented_funcs = [
+                ['rate_constants_no_derivatives',''],
+                ['rate_constants_with_derivatives',''],
+                ]
 
-            for func,tempname in indented_funcs:
-                if not tempname:
-                    tempname = func
-                self._function_substitutions[func] = indent_string(templates[tempname],1)
-            compiled_funcs = [
-                    ['rate_constants','rate_constants_with_derivatives'],
-                    ['interaction_function',self.adsorbate_interaction_model+'_interaction_function'],
-                    ['interacting_mean_field_steady_state',''],
-                    ['ideal_mean_field_steady_state',''],
-                    ['interacting_mean_field_jacobian',''],
-                    ['ideal_mean_field_jacobian',''],
-                    ['constrain_coverage_function','constrain_coverages'],
-                    ['elementary_rates',''],
+        for func,tempname in indented_funcs:
+            if not tempname:
+                tempname = func
+            self._function_substitutions[func] = indent_string(function_templates[tempname],1)
+        compiled_funcs = [
+                ['rate_constants','rate_constants_with_derivatives'],
+                ['interaction_function',self.adsorbate_interaction_model+'_interaction_function'],
+                ['interacting_mean_field_steady_state',''],
+                ['ideal_mean_field_steady_state',''],
+                ['interacting_mean_field_jacobian',''],
+                ['ideal_mean_field_jacobian',''],
+                ['constrain_coverage_function','constrain_coverages'],
+                ['elementary_rates',''],
+                ]
+        if self.sparse_jacobian == True:
+            compiled_funcs += [
+                    ['interacting_mean_field_sparse_jacobian',''],
+                    ['ideal_mean_field_sparse_jacobian',''],
                     ]
 
-            for func,tempname in compiled_funcs:
-                if not tempname:
-                    tempname = func
-                self._function_templates[func] = templates[tempname]
-            self.generate_static_functions()
-
-            if self.optimize_analytical_expressions:
-                test_theta = [self._mpfloat(random.random()) for a in self.adsorbate_names]
-                test_params = [self._mpfloat(random.random()) for a in self.adsorbate_names+self.transition_state_names]
-                test_kfs = [self._mpfloat(random.random()) for a in self.elementary_rxns]
-                test_krs = [self._mpfloat(random.random()) for a in self.elementary_rxns]
-                test_p = [self._mpfloat(random.random()) for a in self.gas_names]
-                test_gas_E = [self._mpfloat(random.random()) for a in self.gas_names]
-                test_site_E = [self._mpfloat(random.random()) for a in self.site_names]
-                test_T = 500
-                test_smearing = 0.02
-                arg_dict = {
-                        'interacting_mean_field_steady_state':[
-                            test_params,test_theta,test_p,test_gas_E,test_site_E,
-                            test_T,self.interaction_response_function,
-                            self._mpfloat,self._matrix,self._math.exp],
-                        'ideal_mean_field_steady_state':[
-                            test_kfs, test_krs, test_theta, test_p,
-                            self._mpfloat, self._matrix],
-                        'interacting_mean_field_jacobian':[
-                            test_params,test_theta,test_p,test_gas_E,test_site_E,
-                            test_T,self.interaction_response_function,
-                            self._mpfloat, self._matrix, self._math.exp],
-                        'ideal_mean_field_jacobian':[
-                            test_kfs, test_krs, test_theta, test_p,
-                            self._mpfloat, self._matrix]
-                        }
-
-                for func in arg_dict:
-                    args= arg_dict[func]
-                    old_str = self._function_strings[func]
-                    insertion_line = None
-
-                    for i,li in enumerate(old_str.split('\n')):
-                        if '    s['+str(len(self.site_names)-1)+']' in li:
-                            insertion_line = i+1
-
-                    if insertion_line is None:
-                        raise ValueError('Could not find line for inserting optimizations')
-
-                    #optimize string
-                    func_string = self.optimize_analytical_function(func,old_str,
-                            insertion_line,1,*args)
-
-                    #re-compile optimized function
-                    self._function_strings[func] = func_string
-                    locs = {}
-                    exec func_string in globals(), locs
-                    setattr(self,func,locs[func])
+        for func,tempname in compiled_funcs:
+            if not tempname:
+                tempname = func
+            self._function_templates[func] = function_templates[tempname]
+        self.generate_static_functions()
 
-            self._compiled = True
+        if optimize:
+            self.check_optimized_functions(expressions)
 
-            if self.adsorbate_interaction_model not in [None,'ideal']:
-                self.steady_state_function = self.interacting_steady_state_function
-            else:
-                self.steady_state_function = self.ideal_steady_state_function
+    def check_optimized_functions(self,expressions):
+        """Compare the functions generated from the optimized expressions 
+        with the functions generated from the unoptimized expressions 
+        (dictionary of substitution name:list of lines) at random inputs, 
+        and use the unoptimized functions if they differ."""
+        test_theta = [self._mpfloat(random.random()) for a in self.adsorbate_names]
+        test_params = [self._mpfloat(random.random()) for a in self.adsorbate_names+self.transition_state_names]
+        test_kfs = [self._mpfloat(random.random()) for a in self.elementary_rxns]
+        test_krs = [self._mpfloat(random.random()) for a in self.elementary_rxns]
+        test_p = [self._mpfloat(random.random()) for a in self.gas_names]
+        test_gas_E = [self._mpfloat(random.random()) for a in self.gas_names]
+        test_site_E = [self._mpfloat(random.random()) for a in self.site_names]
+        test_T = 500
+        data_matrix = lambda data,rows,cols,n: self._matrix(data)
+        interacting_args = [test_params,test_theta,test_p,test_gas_E,
+                test_site_E,test_T,self.interaction_response_function,
+                self._mpfloat,self._matrix,self._math.exp]
+        ideal_args = [test_kfs, test_krs, test_theta, test_p,
+                self._mpfloat, self._matrix]
+        arg_dict = {
+                'interacting_mean_field_steady_state':interacting_args,
+                'ideal_mean_field_steady_state':ideal_args,
+                'interacting_mean_field_jacobian':interacting_args,
+                'ideal_mean_field_jacobian':ideal_args,
+                'interacting_mean_field_sparse_jacobian':
+                    interacting_args[:-2]+[data_matrix,self._math.exp],
+                'ideal_mean_field_sparse_jacobian':
+                    ideal_args[:-1]+[data_matrix],
+                }
 
-    def optimize_analytical_function(self,func_name,func_string,insertion_line,indention_level,*test_args):
-        """Replace some common multiplication terms to speed up functions"""
-
-        locs = {}
-        exec func_string in globals(), locs
-        unoptimized = locs[func_name]
-
-        #replace common multiplications with substitution
-        mult_regex = '((?:(?:k(?:f|r)\[\d\]|theta\[\d\]|p\[\d\]|s\[\d\])\*?)+ +)'
-        opt_strs   = []
-        match = re.findall(mult_regex,func_string)
-        matches = []
-        for m in match:
-            if m.count('*') and func_string.count(m) > 1:
-                matches.append((-1*m.count('*'),func_string.count(m),m))
-        matches = list(set(matches))
-        matches = sorted(matches)
-        for i,m in enumerate(matches):
-            opt_strs.append(m[-1].strip())
-            func_string = func_string.replace(m[-1].strip(),'subs['+str(i)+'] ')
-
-        sub_dict = {
-                    '':r'( +1\*|\-1\*\-1\*| +0 +\+| +1\.0\*)+',
-                    ' + ':r'( +\- *\-1\*| +\+ *1\*| +\+ *\+ +)+',
-                    ' - ':r'( +\+ *\-1\*| +\- *1\*| +\+ *\- +| +0 +\-|\-1\*|\-1\*1\*)',
-                    }
-        
-        opt_str = '\n'+'    '*indention_level+'subs = [0]*'+str(len(opt_strs))
-        for i,op in enumerate(opt_strs):
-            opt_str += '\n'+'    '*indention_level+ 'subs['+str(i)+'] = '+op
-
-        func_lines = func_string.split('\n')
-        func_lines.insert(insertion_line, opt_str)
-        func_string = '\n'.join(func_lines)
-
-        mtch = 1
-        while mtch:
-            new_fn = func_string
-            mtch = None
-            for sub in sub_dict:
-                rgx = sub_dict[sub]
-                mtch = re.findall(rgx,func_string)
-                for m in list(set(mtch)):
-                    func_string = func_string.replace(m,sub)
-
-        locs = {}
-        exec func_string in globals(), locs
-
-        optimized = locs[func_name]
-        delta = np.array((optimized(*test_args) - unoptimized(*test_args)).tolist()).max()
-
-        if delta > 10**(-(self.decimal_precision-1)):
-            print('Warning: Function optimization failed for '+\
-                    func_name+'. Using unoptimized functions')
-            func_string = '\n'.join(func_lines)
-            return func_string
-        else:
-            return func_string
+        tolerance = 10**(-(self.decimal_precision-1))
+        if self._mpfloat == float:
+            tolerance = max(tolerance,1e-10)
+
+        substitutions = dict(self._function_substitutions)
+        for key in expressions:
+            substitutions[key] = '\n    '.join(expressions[key])
+
+        for func in arg_dict:
+            if func not in self._function_templates: #e.g. sparse
+                continue
+            template = Template(self._function_templates[func])
+            func_string = template.substitute(substitutions)
+            locs = {}
+            exec func_string in globals(), locs
+            unoptimized = locs[func]
+            optimized = getattr(self,func)
+            args = arg_dict[func]
+            expected = np.array(unoptimized(*args).tolist(),dtype=object)
+            delta = np.array(optimized(*args).tolist(),dtype=object)
+            delta = abs(delta - expected).max()/max(abs(expected).max(),1)
+            if delta > tolerance:
+                print('Warning: Function optimization failed for '+\
+                        func+'. Using unoptimized functions')
+                self._function_strings[func] = func_string
+                setattr(self,func,unoptimized)
@@ -116,6 +116,14 @@ class ThermoCorrections(ReactionModelWrapper):
         self._frequency_dict = frequency_dict
         return correction_dict
 
+    def get_temperature_derivatives(self,species_list):
+        """Temperature derivatives dG/dT = -S (eV/K) of the thermodynamic 
+        corrections to the free energies of the species in species_list at 
+        the current thermodynamic state. Species without a correction 
+        give 0."""
+        self.get_thermodynamic_corrections()
+        return [-self._entropy_dict.get(sp,0) for sp in species_list]
+
     def ideal_gas(self):
         """Function to calculate the thermal correction to the free energy of 
         an ideal gas using the IdealGasThermo class in ase.thermochemistry 